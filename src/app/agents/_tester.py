@@ -9,6 +9,10 @@ from app.system.base import AgentThreadedWithEvents
 
 class TesterAgent(AgentThreadedWithEvents):
 
+    MAILBOX_COALESCE={"__timer__":   2
+                      ,"mb_detected": None
+                      }
+
     TIMERS_SPEC=[    
          ("sec", 1, "t_sec")
         ,("min", 1, "t_min")
@@ -27,5 +31,8 @@ class TesterAgent(AgentThreadedWithEvents):
         pass
         #print "%s: >>> Tester: mb_detected: %s" % (time.time(), state)
         
+## Usage
+"""
 _=TesterAgent()
 _.start()
+"""
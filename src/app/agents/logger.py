@@ -45,7 +45,8 @@
 import os
 import copy
 import logging
-from app.system.base    import AgentThreadedBase
+from app.system.base    import AgentThreadedWithEvents
+from app.system.mailbox import DROP_NEWEST
 
 __all__=["LoggerAgent"]
 
@@ -56,7 +57,17 @@ HOUR=2
 DAY=3
 
 
-class LoggerAgent(AgentThreadedBase):
+class LoggerAgent(AgentThreadedWithEvents):
+
+    ## don't let a slow disk hold the whole system
+    MAILBOX_SIZE=1000
+    MAILBOX_DEFAULT_POLICY=DROP_NEWEST
+    
+    TIMERS_SPEC=[ ("sec",  1, "t_second")
+                 ,("min",  1, "t_minute")
+                 ,("hour", 1, "t_hour")
+                 ,("day",  1, "t_day")
+                 ]
 
     MLEVEL={"info":     logging.INFO
             ,"warning": logging.WARNING
@@ -74,7 +85,7 @@ class LoggerAgent(AgentThreadedBase):
         """
         @param interval: interval in seconds
         """
-        AgentThreadedBase.__init__(self)
+        AgentThreadedWithEvents.__init__(self)
         self.credits=credits or self.DEFAULTS
         self.buckets={}
         self.dailyQuotaReached={}
@@ -115,23 +126,22 @@ class LoggerAgent(AgentThreadedBase):
         ## our quick lookup dict too
         self.dailyQuotaReached={}
             
-    def h___tick__(self, ticks_second, 
-               tick_second, tick_min, tick_hour, tick_day, 
-                sec_count, min_count, hour_count, day_count):
-        """
-        Time base - used by the rate limiting function
-        """
-        if tick_second:
-            self._cascadeCredits(SEC)
-        if tick_min:
-            self._cascadeCredits(MIN)
-            self._cascadeCredits(SEC)
-        if tick_hour:
-            self._cascadeCredits(HOUR)
-            self._cascadeCredits(MIN)
-            self._cascadeCredits(SEC)            
-        if tick_day:
-            self._resetBuckets()
+    ## Time base - used by the rate limiting function
+    ##
+    def t_second(self, *_):
+        self._cascadeCredits(SEC)
+        
+    def t_minute(self, *_):
+        self._cascadeCredits(MIN)
+        self._cascadeCredits(SEC)
+        
+    def t_hour(self, *_):
+        self._cascadeCredits(HOUR)
+        self._cascadeCredits(MIN)
+        self._cascadeCredits(SEC)            
+        
+    def t_day(self, *_):
+        self._resetBuckets()
             
     def _cascadeCredits(self, bottomBucket):
         """
@@ -3,6 +3,8 @@
     
     Messages Processed:
     - "mb_track?" : to send through Dbus using "qTrack" signal
+                    (the proxy answers one track per question: a batch
+                     of questions is sent as one signal per track)
     
     Messages Generated:
     - "mb_tracks": issued as a result of receiving a "Tracks" signal on Dbus
@@ -80,6 +82,8 @@ class DbusAgent(AgentThreadedBase):
         """
         self.pub("mb_detected_count", self.srx.mb_detected_count)
             
-
+## Usage
+"""
 _=DbusAgent()
 _.start()
+"""
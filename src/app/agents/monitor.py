@@ -27,6 +27,10 @@ class MonitoringAgent(AgentThreadedWithEvents):
         ,("sec",  10, "t_checkMbCount")
     ]
     
+    MAILBOX_COALESCE={"__timer__":         2
+                      ,"mb_detected_count": None
+                      }
+    
     THRESHOLDS = {
         "mb": 2
     }
@@ -85,6 +89,8 @@ class MonitoringAgent(AgentThreadedWithEvents):
         else:
             self.counters["mb_last_advertised"] += 1
         
-        
+## Usage
+"""
 _=MonitoringAgent()
 _.start()
+"""
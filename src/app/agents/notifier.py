@@ -21,6 +21,7 @@ except:
     pass
 
 from app.system.base import AgentThreadedBase
+from app.system.mailbox import DROP_NEWEST
 
 __all__=["NotifierAgent", "notify"]
 
@@ -36,6 +37,9 @@ def notify(app_name, icon_name, msg):
 
 class NotifierAgent(AgentThreadedBase):
     
+    MAILBOX_SIZE=32
+    MAILBOX_DEFAULT_POLICY=DROP_NEWEST
+    
     def __init__(self, app_name, icon_name):
         AgentThreadedBase.__init__(self)
         self.app_name=app_name
@@ -12,10 +12,22 @@
     - "in_rating"
     - "rating_uploaded" : signals that a specific entry as been uploaded to the web-service
     - "to_update" : received from 'ratings_db' once an entry has been cleared for upload
+                    (usually as a batch: written as one work item)
+    - "mb_tracks" : answer of the Musicbrainz proxy
         
     Messages Emitted:
     =================
     - "to_upload" : list of entries to upload to web-service
+    - "mb_track?" : one batch per minute
+    
+    MBID resolution:
+    ================
+    The tracks with an unknown MBID are looked up by distinct (artist, track)
+    pair.  A pair asked is 'in flight' until answered or until it times out
+    (MBID_REQUEST_TIMEOUT): it isn't asked again in the meantime.
+    The answers are collected and applied in one transaction.
+    
+    The database writer doesn't reply: its errors are logged from the writer thread.
     
 
     @author: jldupont
@@ -24,6 +36,7 @@
 import time
 
 from app.system.db import DbHelper
+from app.system import dbservice
 from app.system.base import AgentThreadedWithEvents
 
 __all__=["RatingsCacheAgent",]
@@ -32,6 +45,7 @@ __all__=["RatingsCacheAgent",]
 class RatingsCacheAgent(AgentThreadedWithEvents):
     
     TIMERS_SPEC=[ ("min", 1, "t_processMbid")
+                 ,("sec", 10, "t_applyMbids")
                  ,("min", 1, "t_findUploads")
                  #,("min", 1, "t_processDetectMb")
                  ]
@@ -47,69 +61,111 @@ class RatingsCacheAgent(AgentThreadedWithEvents):
                   ,("rating",      "float")
                   ]
     
+    NATURAL_KEY=["artist_name", "album_name", "track_name"]
+    
+    ## (name, columns, where) - the natural key index serves the track lookups
+    INDEXES=[("artist_track",  ["artist_name", "track_name"], None)
+             ,("updated",      ["updated", "id"],             None)
+             ,("mbid_pending", ["artist_name", "track_name"], "track_mbid=''")
+             ,("mbid_known",   ["updated", "id"],             "track_mbid<>''")
+             ]
+    
+    ## (version, step) - see app.system.db
+    MIGRATIONS=[]
+    
+    STATEMENTS={"update_mbid":         """UPDATE %(table)s SET track_mbid=? 
+                                            WHERE artist_name=? AND track_name=?"""
+                ,"uploads_known_mbid": """SELECT * FROM %(table)s WHERE track_mbid<>'' AND track_mbid<>'?' 
+                                            ORDER BY updated ASC LIMIT ?"""
+                ,"uploads":            """SELECT * FROM %(table)s ORDER BY updated ASC LIMIT ?"""
+                ,"mbid_pending":       """SELECT DISTINCT artist_name, track_name FROM %(table)s 
+                                            WHERE track_mbid='' LIMIT ?"""
+                }
+    
+    MAILBOX_COALESCE={"__timer__":   2
+                      ,"mb_detected": None
+                      }
+    
     BATCH_UPLOAD_MAX=100
     BATCH_MBID_MAX=200
+    
+    ## seconds
+    MBID_REQUEST_TIMEOUT=600
     #MB_DETECT_GONE_THRESHOLD=3 ## minutes
     
     def __init__(self, dbpath, dev_mode=False):
         AgentThreadedWithEvents.__init__(self)
-        self.dbh=DbHelper(dbpath, "ratings_cache", self.TABLE_PARAMS)
+        self.dbpath=dbpath
+        self.dbh=DbHelper(dbpath, "ratings_cache", self.TABLE_PARAMS, self.NATURAL_KEY, self.INDEXES, self.MIGRATIONS,
+                          statements=self.STATEMENTS)
         self.mb_detected=False
         
-    def h_to_update(self, source, ref, timestamp, artist_name, album_name, track_name, rating):
+        ## (artist_name, track_name) -> deadline
+        self.mb_inflight={}
+        
+        ## (artist_name, track_name) -> track_mbid : answers not yet applied
+        self.mb_answers={}
+        self.mb_seq=0
+        
+    def h_to_update(self, *pargs):
         """
         Caches the rating locally once the database has determine it is OK to do so
         """
-            
-        now=time.time()        
-        statement="""UPDATE %s SET updated=?, rating=? 
-                    WHERE artist_name=? AND album_name=? AND track_name=?""" % self.dbh.table_name
+        self.hb_to_update([pargs])
+        
+    def hb_to_update(self, batch):
+        """
+        From 'ratings_db' - the ratings of one flush
+        
+        Written through the database writer service - one work item
+        """
+        dbservice.submit(self.dbpath, self._writeRatings, (list(batch),))
+        
+    def _writeRatings(self, cursor, batch):
+        """
+        Writer thread
+        
+        batch: [(source, ref, timestamp, artist_name, album_name, track_name, rating)]
+        """
+        now=time.time()
         try:
-            self.dbh.executeStatement(statement, timestamp, rating, 
-                                      artist_name, album_name, track_name)
-            self.dbh.commit()
+            for source, _ref, timestamp, artist_name, album_name, track_name, rating in batch:
+                self.dbh.upsert({"created":      now
+                                 ,"updated":     timestamp
+                                 ,"source":      source
+                                 ,"artist_name": artist_name
+                                 ,"album_name":  album_name
+                                 ,"track_name":  track_name
+                                 ,"track_mbid":  ""
+                                 ,"rating":      rating
+                                 }, insert_only=["created", "source", "track_mbid"], cursor=cursor)
         except Exception,e:
-            self.pub("llog", "fpath/cache", "error", "Database insertion error (%s)" % e)
-            self.dprint("cache: update error: %s" % e)
-            return
-
-        rc=self.dbh.rowCount()
-        if rc>0:
-            self.dprint("! rating updated in cache: artist(%s) album(%s) track(%s) rating(%s)" % (artist_name, album_name, track_name, rating))
-            return            
-        
-        if rc==0:
-            statement="""INSERT INTO %s (created, updated,
-                                source,
-                                artist_name, 
-                                album_name, 
-                                track_name,
-                                track_mbid,
-                                rating) 
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""" % self.dbh.table_name
-            try:
-                self.dbh.executeStatement(statement, now, timestamp, source,
-                                          artist_name, album_name, track_name, "", rating)
-                self.dbh.commit()
-            except Exception,e:
-                self.pub("llog", "fpath/cache", "error", "Database insertion error (%s)" % e)
-                self.dprint("cache: insertion error: %s" % e)
-                return
-
-            self.dprint("! rating inserted in cache: artist(%s) album(%s) track(%s) rating(%s)" % (artist_name, album_name, track_name, rating))
+            self.pub("llog", "fpath/cache", "error", "Database update error (%s)" % e)
+            raise
                 
-    def _updateMbid(self, artist_name, track_name, track_mbid):
+    def _applyMbids(self):
+        """
+        Updates the track_mbid parameter of the tracks answered so far
+        
+        Written through the database writer service - one work item i.e. one transaction
+        """
+        if not self.mb_answers:
+            return
+        
+        answers=[(track_mbid, artist_name, track_name) 
+                 for (artist_name, track_name), track_mbid in self.mb_answers.iteritems()]
+        self.mb_answers={}
+        dbservice.submit(self.dbpath, self._writeMbids, (answers,))
+        
+    def _writeMbids(self, cursor, answers):
         """
-        Updates the track_mbid parameter of specified tracks
+        Writer thread
         """
-        statement="""UPDATE %s SET 
-                    track_mbid=?
-                    WHERE artist_name=? AND track_name=?""" % self.dbh.table_name
         try:
-            self.dbh.executeStatement(statement, track_mbid, artist_name, track_name)
-            self.dbh.commit()
+            cursor.executemany(self.dbh.getStatement("update_mbid"), answers)
         except Exception,e:
             self.pub("llog", "fpath/cache", "error", "Database update error (%s)" % e)
+            raise
 
     def _getUploadBatch(self, known_mbid=True, limit=200):
         """
@@ -123,16 +179,9 @@ class RatingsCacheAgent(AgentThreadedWithEvents):
         else:
             lim=min(limit, self.BATCH_UPLOAD_MAX)
         
-        if known_mbid:
-            statement="""SELECT * FROM %s 
-                        WHERE track_mbid<>'' AND track_mbid<>'?' ORDER BY updated ASC LIMIT %s""" % (self.dbh.table_name, lim)
-        else:
-            statement="""SELECT * FROM %s 
-                        ORDER BY updated ASC LIMIT %s""" % (self.dbh.table_name, lim)
-            
         try:
-            self.dbh.executeStatement(statement)
-            results=self.dbh.fetchAllEx([])
+            self.dbh.executeNamed("uploads_known_mbid" if known_mbid else "uploads", lim)
+            results=list(self.dbh.iterAllEx())
         except Exception,e:
             self.pub("llog", "fpath/cache", "error", "Database reading error (%s)" % e)
             self.dprint("cache: database read error: %s" % e)
@@ -157,11 +206,13 @@ class RatingsCacheAgent(AgentThreadedWithEvents):
         
         If this fails, no matter: it will be caught & retried later
         """
-        try:
-            self.dbh.deleteById(id)
-            self.dbh.commit()
-        except:
-            pass
+        dbservice.submit(self.dbpath, self._deleteEntry, (id,))
+        
+    def _deleteEntry(self, cursor, id):
+        """
+        Writer thread
+        """
+        self.dbh.deleteById(id, cursor)
 
     def h_mb_tracks(self, _source, ref, list_dic):
         """
@@ -184,11 +235,21 @@ class RatingsCacheAgent(AgentThreadedWithEvents):
                 if track_mbid=="":
                     track_mbid="?"
                     self.pub("log", "Track Mbid not found: artist(%s) title(%s)" % (artist_name, track_name))
-                self._updateMbid(artist_name, track_name, track_mbid)
+                    
+                key=(artist_name, track_name)
+                self.mb_inflight.pop(key, None)
+                self.mb_answers[key]=track_mbid
                 #print "Track updated: artist(%s) title(%s)" % (artist_name, track_name)
         except Exception,e:
             self.pub("llog", "fpath/cache", "error", "RatingsCache: problem updating 'track_mbid' (%s)" % e)
             
+        if len(self.mb_answers) >= self.BATCH_MBID_MAX:
+            self._applyMbids()
+            
+    def h_shutdown(self):
+        self._applyMbids()
+        dbservice.drain(self.dbpath, 5)
+            
     ## ===============================================================================
     ## =============================================================================== EVENTS
     ## ===============================================================================
@@ -198,19 +259,36 @@ class RatingsCacheAgent(AgentThreadedWithEvents):
         """
         Timer elapsed - Mbid processing
         """
-        statement="""SELECT * FROM %s
-                    WHERE track_mbid='' LIMIT ?""" % self.dbh.table_name
-
+        now=time.time()
+        for key, deadline in self.mb_inflight.items():
+            if deadline<=now:
+                del self.mb_inflight[key]
+        
+        ## the pairs in flight or answered are still pending in the database
+        limit=self.BATCH_MBID_MAX+len(self.mb_inflight)+len(self.mb_answers)
         try:
-            self.dbh.executeStatement(statement, self.BATCH_MBID_MAX)
-            entries=self.dbh.fetchAllEx([])
+            pairs=self.dbh.executeRows("mbid_pending", limit)
         except Exception,e:
             self.pub("llog", "fpath/cache", "error", "Database reading error (%s)" % e)
             return
+        
+        requests=[]
+        deadline=now+self.MBID_REQUEST_TIMEOUT
+        for artist_name, track_name in pairs:
+            key=(artist_name, track_name)
+            if key in self.mb_inflight or key in self.mb_answers:
+                continue
+            self.mb_inflight[key]=deadline
+            self.mb_seq += 1
+            requests.append(("musync:%s" % self.mb_seq, artist_name, track_name, "low"))
+            if len(requests)>=self.BATCH_MBID_MAX:
+                break
             
-        for entry in entries:
-            ref="musync:%s" % entry["id"]
-            self.pub("mb_track?", ref, entry["artist_name"], entry["track_name"], "low")
+        if requests:
+            self.pub_many("mb_track?", requests)
+        
+    def t_applyMbids(self, *_):
+        self._applyMbids()
         
     """
     def t_processDetectMb(self, *_):
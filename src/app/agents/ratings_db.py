@@ -4,27 +4,104 @@
     Messages Processed:
     ===================
     - "in_rating":    store the entry in the db
-    - "in_qrating":   returns the associated rating
+    - "in_qrating":   returns the associated rating (an empty one if the track isn't rated)
     - "in_qratings":  returns the ratings list starting from "timestamp" and DESCending up to LIMIT
+    - "in_qratings_page": same as "in_qratings" but starting after a continuation token
+    - "in_qratings_chunked": same as "in_qratings_page" with the answer in chunks
     - "to_update" : if the database determines that no record / new update
+    - "ratings_flushed": reply of the database writer
+    
+    Messages Emitted:
+    =================
+    - "out_rating" : one per rating returned
+    - "out_ratings_page" (source, ref, token) : follows the ratings of a page,
+      'token' continues the walk (None once the history is exhausted)
+    - "out_ratings_chunk" (source, ref, seq, eos, token, entries) : chunked answer,
+      entries: [(source, timestamp, artist_name, album_name, track_name, rating)]
+      'eos' is True on the last chunk, which carries the continuation token
+    
+    The incoming ratings are buffered (write-behind) and written
+    to the database in batches through the database writer service.
+    
+    The answers to "qrating" are served from an LRU cache, populated
+    on read (including "no rating" answers) and refreshed with the values
+    written by each flush: the cache always holds what the database holds.
+    The 'updated' column of a rating is the timestamp given by its source.
+    
+    A Bloom filter of the known tracks answers the questions about never rated
+    tracks without a database lookup.  It is built from the database in chunks,
+    by a timer, once the Agent runs (and again when full): in the meantime the
+    current filter, at startup one letting every question through, stays in use.
             
     Created on 2010-08-19
     @author: jldupont
 """
 import time
-from app.system.db import DbHelper
+from app.system.db import DbHelper, UPSERT_UNCHANGED, MAX_ID
+from app.system import dbservice
 from app.system.base import AgentThreadedWithEvents
+from app.system.mailbox import DROP_OLDEST
+from app.system.lru import LruCache
+from app.system.bloom import BloomFilter
 
 __all__=["RatingsDbAgent"]
 
+## cache lookup: not to be confused with a cached 'unrated' (None)
+_MISS=object()
+
+
+class _Everything(BloomFilter):
+    """
+    Fallback filter: every track might be known
+    """
+    def __contains__(self, key):
+        return True
+
 class RatingsDbAgent(AgentThreadedWithEvents):
     
     MAX_RETRIEVE_LIMIT=1000
     
+    ## rows per "out_rating" batch
+    QRATINGS_CHUNK=100
+    
+    ## chunked answers: a handful of messages even for large counts
+    MAX_CHUNKED_RETRIEVE_LIMIT=10000
+    RATINGS_CHUNK_SIZE=200
+    
+    ## ratings are never dropped: the publisher is held back instead.
+    ## Stale questions are not worth answering.
+    MAILBOX_SIZE=5000
+    MAILBOX_POLICIES={"in_qrating":           DROP_OLDEST
+                      ,"in_qratings":         DROP_OLDEST
+                      ,"in_qratings_page":    DROP_OLDEST
+                      ,"in_qratings_chunked": DROP_OLDEST
+                      }
+    
     TIMERS_SPEC=[ #("min", 1, "t_announceDbCount")
                  ("min", 1, "t_announceUpdated")  
+                 ,("sec", 2, "t_flushRatings")
+                 ,("hour", 1, "t_reportCache")
+                 ,("sec", 1, "t_buildKnownFilter")
                  #,("sec", 10, "t_countRatings")
                  ]
+    
+    ## write-behind buffer: maximum count of tracks pending
+    WRITE_BEHIND_MAX=500
+    
+    ## "qrating" cache: tracks, bytes
+    QRATING_CACHE_ENTRIES=5000
+    QRATING_CACHE_BYTES=2*1024*1024
+    
+    ## known tracks filter: sized for twice the tracks in the database (at least)
+    KNOWN_FILTER_MIN_CAPACITY=10000
+    KNOWN_FILTER_ERROR_RATE=0.01
+    
+    ## known tracks filter build: keys read per timer tick
+    KNOWN_FILTER_BUILD_CHUNK=10000
+    
+    ## seconds
+    SHUTDOWN_DRAIN_TIMEOUT=5
+    QUERY_DRAIN_TIMEOUT=2
 
     TABLE_PARAMS=[("id",           "integer primary key")
                   ,("created",     "integer")
@@ -38,11 +115,51 @@ class RatingsDbAgent(AgentThreadedWithEvents):
                   ,("rating",      "float")
                   ]
     
+    NATURAL_KEY=["artist_name", "album_name", "track_name"]
+    
+    ## (name, columns, where) - the natural key index serves the track lookups
+    INDEXES=[("updated", ["updated", "id"], None)
+             ]
+    
+    ## (version, step) - see app.system.db
+    MIGRATIONS=[]
+    
+    STATEMENTS={"rating":   """SELECT source, updated, rating FROM %(table)s 
+                                WHERE artist_name=? AND album_name=? AND track_name=? LIMIT 1"""
+                ,"keys":    """SELECT id, artist_name, album_name, track_name FROM %(table)s 
+                                WHERE id>? ORDER BY id LIMIT ?"""
+                }
+    
+    ## history walk (keyset pagination, see app.system.db): "out_rating" order
+    RATINGS_COLUMNS=["source", "updated", "artist_name", "album_name", "track_name", "rating"]
+    
     def __init__(self, dbpath, dev_mode=False):
         AgentThreadedWithEvents.__init__(self)
         
         self.current_count=0
-        self.dbh=DbHelper(dbpath, "ratings_db", self.TABLE_PARAMS)
+        self.dbpath=dbpath
+        self.dbh=DbHelper(dbpath, "ratings_db", self.TABLE_PARAMS, self.NATURAL_KEY, self.INDEXES, self.MIGRATIONS,
+                          statements=self.STATEMENTS)
+        
+        ## (artist_name, album_name, track_name) -> (source, ref, timestamp, rating)
+        self.pending={}
+        
+        ## flush sequence -> batch being written
+        self.flush_seq=0
+        self.inflight={}
+        
+        ## (artist_name, album_name, track_name) -> (source, updated, rating) or None if unrated
+        self.cache=LruCache(self.QRATING_CACHE_ENTRIES, self.QRATING_CACHE_BYTES)
+        
+        ## filter lookups answered 'maybe' but not found in the database
+        self.known=_Everything()
+        self.known_negatives=0
+        self.known_false_positives=0
+        
+        ## filter being built & last id read - see t_buildKnownFilter
+        self.known_build=None
+        self.known_build_id=0
+        self._startKnownFilter()
 
     ## ======================================================================
     ## MESSAGE HANDLERS
@@ -51,117 +168,350 @@ class RatingsDbAgent(AgentThreadedWithEvents):
         """
         From Dbus "rating"
         
-        First check if we have a different value in the database - if not, abort.
+        Write-behind: the rating is buffered, keeping only the newest per track,
+        and the buffer is flushed on size (WRITE_BEHIND_MAX) or time (t_flushRatings)
         """
-        statement="""SELECT * FROM %s WHERE artist_name=? AND album_name=? AND track_name=? AND rating<>? LIMIT 1
-                    """ % self.dbh.table_name
-        try:
-            self.dbh.executeStatement(statement, artist_name, album_name, track_name, rating)
-            result=self.dbh.fetchOne(None)
-        except Exception,e:
-            self.pub("llog", "fpath/cache", "error", "Database reading error (%s)" % e)
-            return
-
-        ### Can't be found OR different rating... then add to the database AND signal
-        ###  so that the 'cache' also put to record ready for uploading to the web-service
-        if result is None:
-            now=time.time()
-            ### First try to update if possible
-            statement="""UPDATE %s SET updated=?, rating=?
-                        WHERE artist_name=? AND album_name=? AND track_name=?
-                        """ % self.dbh.table_name
-            try:
-                self.dbh.executeStatement(statement, now, rating, artist_name, album_name, track_name)
-                self.dbh.commit()
-                c=self.dbh.rowCount()
-                if c==1:  ## success
-                    self.dprint("db: updated, a(%s) b(%s) t(%s): %s" % (artist_name, album_name, track_name, rating))
-                    return
-            except Exception,e:
-                self.pub("llog", "fpath/db", "error", "Database update error (%s)" % e)
-                return
-    
-            statement=""" INSERT INTO %s ( created, updated, source, 
-                                            artist_name, album_name, track_name,
-                                            rating)
-                                    VALUES( ?, ?, ?, ?, ?, ?, ?)
-                    """ % self.dbh.table_name
-            try:
-                self.dbh.executeStatement(statement, now, now, source, artist_name, album_name, track_name, rating)
-                self.dbh.commit()
-                self.dprint("db: inserted, a(%s) b(%s) t(%s): %s" % (artist_name, album_name, track_name, rating))
-            except Exception,e:
-                self.pub("llog", "fpath/db", "error", "Database insertion error (%s)" % e)
-                return
+        self._bufferRating(source, ref, timestamp, artist_name, album_name, track_name, rating)
+        if len(self.pending) >= self.WRITE_BEHIND_MAX:
+            self._flushRatings()
             
-            ### help the cache - the way to the web-service
-            self.pub("to_update", source, ref, timestamp, artist_name, album_name, track_name, rating)
+    def hb_in_rating(self, batch):
+        """
+        From Dbus "ratings" - a batch of "rating"
+        
+        The size of the buffer is only checked once the whole batch is buffered
+        """
+        for pargs in batch:
+            self._bufferRating(*pargs)
+        if len(self.pending) >= self.WRITE_BEHIND_MAX:
+            self._flushRatings()
 
+    def h_shutdown(self):
+        self._flushRatings()
+        dbservice.drain(self.dbpath, self.SHUTDOWN_DRAIN_TIMEOUT)
 
     def h_in_qrating(self, source, ref, artist_name, album_name, track_name):
         """
         From Dbus "qrating"
         """
-        statement="""SELECT * FROM %s WHERE artist_name=? AND album_name=? AND track_name=? LIMIT 1
-                    """ % self.dbh.table_name
         try:
-            self.dbh.executeStatement(statement, artist_name, album_name, track_name)
-            result=self.dbh.fetchOneEx2()
-            self.pub("out_rating", result["source"], 
-                                    ref, 
-                                    result["updated"], 
-                                    result["artist_name"], 
-                                    result["album_name"], 
-                                    result["track_name"], 
-                                    result["rating"])
+            answer=self._lookupRating(source, ref, artist_name, album_name, track_name)
         except Exception,e:
             self.pub("llog", "fpath/db", "error", "Database reading error (%s)" % e)
+            return
+        self.pub("out_rating", *answer)
+            
+    def hb_in_qrating(self, batch):
+        """
+        From Dbus "qratings_batch" - a batch of "qrating"
+        
+        The answers are published as one batch
+        """
+        answers=[]
+        try:
+            for source, ref, artist_name, album_name, track_name in batch:
+                answers.append(self._lookupRating(source, ref, artist_name, album_name, track_name))
+        except Exception,e:
+            self.pub("llog", "fpath/db", "error", "Database reading error (%s)" % e)
+        self.pub_many("out_rating", answers)
         
     def h_in_qratings(self, source, ref, timestamp, count):
         """
         From Dbus "qratings"
         """
-        c=min(count, self.MAX_RETRIEVE_LIMIT)
-        u=time.time() if timestamp==0 else timestamp
+        self._syncRatings()
         
-        statement="""SELECT * FROM %s WHERE updated<=? ORDER DESC LIMIT %s
-                """ % (self.dbh.table_name, c)
+        start=None if timestamp==0 else (timestamp, MAX_ID)
         try:
-            self.dbh.executeStatement(statement, u)
-            results=self.dbh.fetchAllEx(None)
-            if results is None:
+            sent, token=self._publishRatings(ref, None, count, start)
+            if sent==0:
                 self.pub("out_rating", source, 
                                         ref, 
                                         timestamp, 
                                         "", "", "", 0.0) 
-                return
+            self.pub("out_ratings_page", source, ref, token)
+        except Exception,e:
+            self.pub("llog", "fpath/db", "error", "Database reading error (%s)" % e)
             
-            ### Burst....
-            for result in results:
-                    self.pub("out_rating", result["source"], 
-                                ref, 
-                                result["updated"], 
-                                result["artist_name"], 
-                                result["album_name"], 
-                                result["track_name"], 
-                                result["rating"])
+    def h_in_qratings_page(self, source, ref, token, count):
+        """
+        From Dbus "qratings_page"
+        
+        Keyset pagination: the page starts right after the row identified
+        by 'token' (None for the most recent rating)
+        """
+        self._syncRatings()
+        
+        try:
+            _sent, token=self._publishRatings(ref, token, count)
         except Exception,e:
             self.pub("llog", "fpath/db", "error", "Database reading error (%s)" % e)
+            token=None
+        self.pub("out_ratings_page", source, ref, token)
+            
+    def h_in_qratings_chunked(self, source, ref, token, count):
+        """
+        From Dbus "qratings_chunked"
+        
+        Same walk as "qratings_page", answered with "out_ratings_chunk" messages
+        of up to RATINGS_CHUNK_SIZE entries: seq 0, 1, ... the last one with eos=True.
+        A chunk is held back until the next one is read so that the last one
+        can be flagged.
+        """
+        self._syncRatings()
+        
+        seq=0
+        held=[]
+        next_token=None
+        try:
+            c=min(count, self.MAX_CHUNKED_RETRIEVE_LIMIT)
+            for rows, next_token in self.dbh.iterPageAfter(token, c, self.RATINGS_COLUMNS, 
+                                                           self.RATINGS_CHUNK_SIZE):
+                if held:
+                    self.pub("out_ratings_chunk", source, ref, seq, False, None, held)
+                    seq += 1
+                held=rows
+        except Exception,e:
+            self.pub("llog", "fpath/db", "error", "Database reading error (%s)" % e)
+            
+        self.pub("out_ratings_chunk", source, ref, seq, True, next_token, held)
+            
+    def _publishRatings(self, ref, token, count, start=None):
+        """
+        Publishes the ratings (updated DESC, id DESC) following 'token' - or 'start' (updated, id)
+        
+        @return (count of ratings published, continuation token)
+        """
+        c=min(count, self.MAX_RETRIEVE_LIMIT)
+        
+        ### Burst.... one batch per chunk: the result set is never held whole
+        sent=0
+        next_token=None
+        for rows, next_token in self.dbh.iterPageAfter(token, c, self.RATINGS_COLUMNS, self.QRATINGS_CHUNK, start):
+            self.pub_many("out_rating", [(row[0], ref)+row[1:] for row in rows])
+            sent += len(rows)
+        return (sent, next_token)
 
         
 
     ## ====================================================================== HELPERS
     ##
+    def _bufferRating(self, source, ref, timestamp, artist_name, album_name, track_name, rating):
+        key=(artist_name, album_name, track_name)
+        entry=self.pending.get(key, None)
+        if entry is not None and entry[2] > timestamp:
+            return
+        
+        self.pending[key]=(source, ref, timestamp, rating)
+        
+        ## answered from the buffer until written - see h_ratings_flushed
+        self.cache.discard(key)
+        
+        self.known.add(key)
+        if self.known_build is not None:
+            self.known_build.add(key)
+        elif self.known.full():
+            self._startKnownFilter()
+            
+    def _lookupRating(self, source, ref, artist_name, album_name, track_name):
+        """
+        A rating still in the write-behind buffer (or being written) is the most recent one,
+        then comes the cache and finally the database - unless the track is unknown.
+        
+        @return "out_rating" arguments - the empty answer if the track isn't rated
+        """
+        unrated=(source, ref, 0, "", "", "", 0.0)
+        
+        key=(artist_name, album_name, track_name)
+        pending=self.pending.get(key, None)
+        for seq in sorted(self.inflight, reverse=True):
+            if pending is not None:
+                break
+            pending=self.inflight[seq].get(key, None)
+        if pending is not None:
+            psource, _pref, timestamp, rating = pending
+            return (psource, ref, timestamp, artist_name, album_name, track_name, rating)
+        
+        cached=self.cache.get(key, _MISS)
+        if cached is not _MISS:
+            if cached is None:
+                return unrated
+            csource, updated, rating = cached
+            return (csource, ref, updated, artist_name, album_name, track_name, rating)
+        
+        if key not in self.known:
+            self.known_negatives += 1
+            return unrated
+        
+        self.dbh.executeNamed("rating", artist_name, album_name, track_name)
+        row=self.dbh.c.fetchone()
+        self.cache.put(key, row)
+        if row is None:
+            self.known_false_positives += 1
+            return unrated
+        rsource, updated, rating = row
+        return (rsource, ref, updated, artist_name, album_name, track_name, rating)
+        
+    def _startKnownFilter(self):
+        """
+        Starts (re)building the filter of the known tracks - see t_buildKnownFilter
+        
+        The tracks buffered during the build are added to the new filter as well.
+        """
+        try:
+            count=self.dbh.getRowCount() or 0
+        except Exception,e:
+            self.pub("llog", "fpath/db", "error", "Database reading error (%s)" % e)
+            return
+        capacity=max(self.KNOWN_FILTER_MIN_CAPACITY, 2*(count+len(self.pending)))
+        self.known_build=BloomFilter(capacity, self.KNOWN_FILTER_ERROR_RATE)
+        self.known_build_id=0
+        
+    def _buildKnownFilter(self):
+        """
+        Adds a chunk of the database's tracks to the filter being built
+        
+        Once the table is read, the tracks not yet written (write-behind buffer,
+        in flight) are included and the new filter replaces the current one.
+        On a database error, the build is abandoned: the current filter stays.
+        """
+        known=self.known_build
+        try:
+            self.dbh.executeNamed("keys", self.known_build_id, self.KNOWN_FILTER_BUILD_CHUNK)
+            rows=self.dbh.fetchAll([])
+        except Exception,e:
+            self.pub("llog", "fpath/db", "error", "Database reading error (%s)" % e)
+            self.known_build=None
+            return
+        
+        for row in rows:
+            known.add(row[1:])
+        if rows:
+            self.known_build_id=rows[-1][0]
+        if len(rows)==self.KNOWN_FILTER_BUILD_CHUNK:
+            return
+            
+        for batch in [self.pending]+self.inflight.values():
+            for key in batch:
+                known.add(key)
+        
+        self.known=known
+        self.known_build=None
+        self.known_negatives=0
+        self.known_false_positives=0
+        
+    def _syncRatings(self):
+        """
+        Flushes the buffered ratings and waits for them to be committed:
+        the queries reading the history must see the latest ratings
+        
+        On timeout, the answer goes without the ratings not yet written.
+        """
+        if not self.pending and not self.inflight:
+            return
+        self._flushRatings()
+        if not dbservice.drain(self.dbpath, self.QUERY_DRAIN_TIMEOUT):
+            self.pub("llog", "fpath/db", "warning", "Database writer late: answering without the latest ratings")
+        
+    def _flushRatings(self):
+        """
+        Submits the buffered ratings to the database writer - one work item
+        
+        The batch is kept 'in flight' until the writer replies ("ratings_flushed")
+        """
+        if not self.pending:
+            return
+        
+        self.flush_seq += 1
+        batch=self.pending
+        self.pending={}
+        self.inflight[self.flush_seq]=batch
+        
+        dbservice.submit(self.dbpath, self._writeRatings, (batch,), 
+                         "ratings_flushed", (self.id, self.flush_seq))
+        
+    def _writeRatings(self, cursor, batch):
+        """
+        Writer thread - one upsert per entry: an existing row is only 
+        rewritten when the rating differs.
+        
+        @return (the entries that changed, {key: (source, updated, rating) as stored})
+        """
+        now=time.time()
+        changed=[]
+        written={}
+        select=self.dbh.getStatement("rating")
+        for key, (source, ref, timestamp, rating) in batch.iteritems():
+            artist_name, album_name, track_name = key
+            status=self.dbh.upsert({"created":      now
+                                    ,"updated":     timestamp or now
+                                    ,"source":      source
+                                    ,"artist_name": artist_name
+                                    ,"album_name":  album_name
+                                    ,"track_name":  track_name
+                                    ,"rating":      rating
+                                    }, compare=["rating"], insert_only=["created", "source"], cursor=cursor)
+            cursor.execute(select, key)
+            written[key]=cursor.fetchone()
+            if status==UPSERT_UNCHANGED:
+                continue
+            changed.append((source, ref, timestamp, artist_name, album_name, track_name, rating))
+        return (changed, written)
+    
+    def h_ratings_flushed(self, token, result, error):
+        """
+        From the database writer
+        
+        The 'qrating' cache is refreshed with the values stored and
+        the 'to_update' message is only issued for the entries that changed.
+        """
+        agent_id, seq = token
+        if agent_id!=self.id:
+            return
+        batch=self.inflight.pop(seq, {})
+        
+        if error is not None:
+            ## retry on next flush unless superseded in the meantime
+            for key, entry in batch.iteritems():
+                self.pending.setdefault(key, entry)
+            self.pub("llog", "fpath/db", "error", "Database update error (%s)" % error)
+            return
+        
+        changed, written = result
+        for key, row in written.iteritems():
+            self.cache.put(key, row)
+        
+        self.dprint("db: flushed %s ratings, %s changed" % (len(batch), len(changed)))
+        
+        ### help the cache - the way to the web-service
+        self.pub_many("to_update", changed)
+
     
 
     ## ====================================================================== TIMERS
     ##
+    def t_flushRatings(self, *_):
+        self._flushRatings()
+        
+    def t_buildKnownFilter(self, *_):
+        if self.known_build is not None:
+            self._buildKnownFilter()
+        
+    def t_reportCache(self, *_):
+        stats=self.cache.stats()
+        self.pub("log", "qrating cache: entries(%(entries)s) bytes(%(bytes)s) hits(%(hits)s) misses(%(misses)s) evictions(%(evictions)s) hit ratio(%(hit_ratio).2f)" % stats)
+        
+        lookups=self.known_negatives+self.known_false_positives
+        observed=float(self.known_false_positives)/lookups if lookups else 0.0
+        self.pub("log", "known tracks filter: keys(%s) capacity(%s) unknown answered(%s) false positives(%s) observed fp rate(%.4f) expected fp rate(%.4f)" % 
+                 (len(self.known), self.known.capacity, self.known_negatives, self.known_false_positives, observed, self.known.fp_rate()))
+        
     def t_announceUpdated(self, *_):
         """
         If there is an issue here it will be caught elsewhere anyhow
         """
         try:
-            e=self.getLatestUpdated()    
+            e=self.dbh.getLatestUpdated()    
             updated=e["updated"]
         except: 
             updated=0
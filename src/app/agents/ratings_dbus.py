@@ -6,11 +6,18 @@
     Messages Processed:
     - "out_rating"  : transit to "/ratings/rating" Dbus message
     - "out_updated" : transit to "/ratings/updated" Dbus message
+    - "out_ratings_page" : transit to "/ratings/ratings_page" Dbus message
+    - "out_ratings_chunk" : transit to "/ratings/ratings_chunk" Dbus message
     
     Messages Generated:
     - "in_rating"
     - "in_qrating"
     - "in_qratings"
+    - "in_qratings_page"
+    - "in_qratings_chunked"
+    
+    The batched signals ("ratings", "qratings_batch") are published
+    on the switch as one batch of "in_rating" / "in_qrating".
     
     ==========================================================
     
@@ -29,8 +36,16 @@
             @param rating: (integer) [0:100]
             
             This signal can be sent with 'artist_name', 'album_name', 'track_name' equal to "" (empty)
-            in response to "qratings" returning no results.
+            in response to "qratings" returning no results or to "qrating" for a track not rated:
+            'ref' then identifies the question.
 
+    * (IN) ratings(source, entries)
+    
+            Batched form of "rating": many tracks per signal
+            
+            @param entries: array of (ref, timestamp, artist_name, album_name, track_name, rating)
+                            i.e. signature "a(sisssd)"
+                            
     * (IN) qratings(source, ref, timestamp, count)
     
             Ratings? from 'timestamp' and descending in time, return a maximum of 'count' records
@@ -40,14 +55,64 @@
             @param timestamp: (integer) the in seconds since the epoch, in UTC
             @param count: (integer) the maximum number records to return
             
-            The response will come in form of "rating" signal(s).
+            The response will come in form of "rating" signal(s) followed by
+            a "ratings_page" signal.
             When using 'timestamp=0', the current time is used i.e. latest entries will be returned.
             
+    * (IN) qratings_page(source, ref, token, count)
+    
+            Ratings? continuing a walk through the history, descending in time
+            
+            @param token: (string) continuation token of the previous "ratings_page", "" to start
+                          from the latest entry
+            @param count: (integer) the maximum number records to return
+            
+            The response will come in form of "rating" signal(s) followed by
+            a "ratings_page" signal.  Each page is retrieved from where the previous
+            one ended: walking the whole history costs one pass over it.
+            
+    * (IN) qratings_chunked(source, ref, token, count)
+    
+            Same as "qratings_page" but the response comes in form of
+            "ratings_chunk" signals, each carrying many entries: use this
+            for large counts.
+            
+    * (OUT) ratings_chunk(source, ref, seq, eos, token, entries)
+    
+            A chunk of the response to "qratings_chunked"
+            
+            @param ref: (string) the reference of the question
+            @param seq: (integer) chunk sequence number, from 0
+            @param eos: (boolean) True on the last chunk of the response
+            @param token: (string) on the last chunk: continuation token for the next
+                          "qratings_chunked", "" when there are no more entries
+            @param entries: array of (source, timestamp, artist_name, album_name, track_name, rating)
+                            i.e. signature "a(sisssd)" - possibly empty
+            
+    * (OUT) ratings_page(source, ref, token)
+    
+            Signal closing the response to "qratings" / "qratings_page"
+            
+            @param ref: (string) the reference of the question
+            @param token: (string) continuation token for the next "qratings_page",
+                          "" when there are no more entries
+            
     * (IN) qrating(source, ref, artist_name, album_name, track_name)
     
             Rating?  Question signal for which Musync will retrieve, if available,
             the rating associated with the specified track.  Musync will reply
-            using the "rating" signal (described above).
+            using the "rating" signal (described above), an empty one if the
+            track isn't rated.
+            
+    * (IN) qratings_batch(source, tracks)
+    
+            Batched form of "qrating": many tracks per signal
+            
+            @param tracks: array of (ref, artist_name, album_name, track_name)
+                           i.e. signature "a(ssss)"
+            
+            The answers come in form of "rating" signals, one per track
+            (empty for the tracks not rated).
             
     * (OUT) updated(timestamp, ratings_count)
     
@@ -85,6 +150,20 @@ class RatingsSignalRx(dbus.service.Object):
                                        path="/ratings"
                                        )
                     
+        dbus.Bus().add_signal_receiver(self.rx_ratings,
+                                       signal_name="ratings",
+                                       dbus_interface="com.systemical.services",
+                                       bus_name=None,
+                                       path="/ratings"
+                                       )
+                    
+        dbus.Bus().add_signal_receiver(self.rx_qratings_batch,
+                                       signal_name="qratings_batch",
+                                       dbus_interface="com.systemical.services",
+                                       bus_name=None,
+                                       path="/ratings"
+                                       )            
+        
         dbus.Bus().add_signal_receiver(self.rx_qratings,
                                        signal_name="qratings",
                                        dbus_interface="com.systemical.services",
@@ -92,6 +171,20 @@ class RatingsSignalRx(dbus.service.Object):
                                        path="/ratings"
                                        )            
         
+        dbus.Bus().add_signal_receiver(self.rx_qratings_page,
+                                       signal_name="qratings_page",
+                                       dbus_interface="com.systemical.services",
+                                       bus_name=None,
+                                       path="/ratings"
+                                       )            
+        
+        dbus.Bus().add_signal_receiver(self.rx_qratings_chunked,
+                                       signal_name="qratings_chunked",
+                                       dbus_interface="com.systemical.services",
+                                       bus_name=None,
+                                       path="/ratings"
+                                       )            
+        
         dbus.Bus().add_signal_receiver(self.rx_qrating,
                                        signal_name="qrating",
                                        dbus_interface="com.systemical.services",
@@ -114,34 +207,73 @@ class RatingsSignalRx(dbus.service.Object):
         """
         Signal emitter for "/ratings/updated"
         """
+
+    @dbus.service.signal(dbus_interface="com.systemical.services", signature="sss")
+    def ratings_page(self, source, ref, token):
+        """
+        Signal emitter for "/ratings/ratings_page"
+        """
+
+    @dbus.service.signal(dbus_interface="com.systemical.services", signature="ssibsa(sisssd)")
+    def ratings_chunk(self, source, ref, seq, eos, token, entries):
+        """
+        Signal emitter for "/ratings/ratings_chunk"
+        """
         
         
     ## ==========================================================================================
     ## SIGNAL RECEIVERS
+    ## continuation tokens: "" on Dbus, None on the switch (see app.system.db)
     def rx_qratings(self, source, ref, timestamp, count):
         mswitch.publish(self, "in_qratings", source, ref, timestamp, count)
 
+    def rx_qratings_page(self, source, ref, token, count):
+        mswitch.publish(self, "in_qratings_page", source, ref, token or None, count)
+
+    def rx_qratings_chunked(self, source, ref, token, count):
+        mswitch.publish(self, "in_qratings_chunked", source, ref, token or None, count)
+
     def rx_qrating(self, source, ref, artist_name, album_name, track_name):
         mswitch.publish(self, "in_qrating", source, ref, artist_name, album_name, track_name)
 
     def rx_rating(self, source, ref, timestamp, artist_name, album_name, track_name, rating):
         mswitch.publish(self, "in_rating", source, ref, timestamp, artist_name, album_name, track_name, rating)
 
+    def rx_ratings(self, source, entries):
+        mswitch.publish_many(self, "in_rating", [(source,)+tuple(entry) for entry in entries])
+
+    def rx_qratings_batch(self, source, tracks):
+        mswitch.publish_many(self, "in_qrating", [(source,)+tuple(track) for track in tracks])
+
 
 
 
 class DbusAgent(AgentThreadedBase):
     
+    MAILBOX_COALESCE={"out_updated": None}
+    
     def __init__(self):
         AgentThreadedBase.__init__(self)
         self.srx=RatingsSignalRx(self)
 
     def h_out_rating(self, source, ref, timestamp, artist_name, album_name, track_name, rating):
-        self.srx.rating(source, timestamp, artist_name, album_name, track_name, rating) 
+        self.srx.rating(source, ref, timestamp, artist_name, album_name, track_name, rating) 
 
     def h_out_updated(self, timestamp, ratings_count):
         self.srx.updated(timestamp, ratings_count)
 
+    def h_out_ratings_page(self, source, ref, token):
+        self.srx.ratings_page(source, ref, token or "")
 
+    def h_out_ratings_chunk(self, source, ref, seq, eos, token, entries):
+        ## timestamps are stored as floats ; an empty array can't be typed from its content
+        entries=[(esource, int(timestamp), artist_name, album_name, track_name, rating) 
+                 for esource, timestamp, artist_name, album_name, track_name, rating in entries]
+        self.srx.ratings_chunk(source, ref, seq, eos, token or "", 
+                               dbus.Array(entries, signature="(sisssd)"))
+
+## Usage
+"""
 _=DbusAgent()
 _.start()
+"""
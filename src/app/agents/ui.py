@@ -129,6 +129,8 @@ class UiWindow(object):
 
 class UiAgent(UiAgentBase):
     
+    MAILBOX_COALESCE={"ratings_count": None}
+    
     def __init__(self, time_base):
         UiAgentBase.__init__(self, time_base)
         
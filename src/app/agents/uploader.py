@@ -9,9 +9,15 @@ import httplib
 import oauth.oauth as oauth
 
 from app.system.base import AgentThreadedBase
+from app.system.mailbox import COALESCE
 
 class UploaderAgent(AgentThreadedBase):
     
+    ## a newer upload batch supersedes a pending one:
+    ##  the entries stay in the cache until uploaded anyhow
+    MAILBOX_SIZE=8
+    MAILBOX_POLICIES={"ratings_to_upload": COALESCE}
+    
     def __init__(self, end_point, server, port, consumer_key, consumer_secret, debug=False):
         AgentThreadedBase.__init__(self, debug)
         self.server=server
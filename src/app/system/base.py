@@ -12,27 +12,134 @@
     @revised: June 18, 2010
     @revised: August 22, 2010 : filtered-out "send to self" case
     @revised: August 23, 2010 : added "snooping mode", remove another message loop, tidied-up    
+    @revised: dual priority mailbox - agents sleep until a message arrives
+    @revised: per-class dispatch table compiled at class creation
+    @revised: static interest declaration upon subscription
+    @revised: batched messages support - "hb_" batch handlers
+    @revised: bounded mailboxes with per message type overflow policies
+    @revised: coalescing of superseded messages
+    @revised: timers delivered by the timers service instead of "__tick__"
 """
 
 from threading import Thread
-from Queue import Queue, Empty
+from Queue import Empty
 import uuid
 
 import mswitch
+import timers
+from app.system.mailbox import Mailbox, BLOCK
 
-__all__=["AgentThreadedBase", "AgentThreadedWithEvents", "debug", "debug_interest" 
-         "mdispatch", 
+__all__=["AgentThreadedBase", "AgentThreadedWithEvents", "debug", "debug_interest", 
+         "AgentType", "compile_dispatch", "declared_interests", "mdispatch", 
          "process_queues", "message_processor"]
 
 debug=False
 debug_interest=False
 
 
+def compile_dispatch(cls):
+    """
+    Compiles the message dispatch table of an Agent class
+    
+    Handler method naming:
+    - "h_<mtype>"    : handler for 'mtype'
+    - "hs_<mtype>"   : snooping handler for 'mtype'
+    - "hq_<mtype>"   : handler for the question 'mtype?'
+    - "hqs_<mtype>"  : snooping handler for the question 'mtype?'
+    - "hb_<mtype>"   : (optional) batch handler for 'mtype'
+    - "h_default"    : catch-all handler
+    
+    A regular handler takes precedence over a snooping one.
+    
+    @return (table, default_handler)
+    
+    table: { mtype: (function, snooping, query, batch_function) }
+    """
+    table={}
+    batch={}
+    for name in dir(cls):
+        if name.startswith("hb_"):
+            attr=getattr(cls, name)
+            if callable(attr):
+                batch[name[3:]]=getattr(attr, "im_func", attr)
+            continue
+        
+        if name.startswith("hqs_"):
+            mtype, snooping, query = name[4:]+"?", True, True
+        elif name.startswith("hq_"):
+            mtype, snooping, query = name[3:]+"?", False, True
+        elif name.startswith("hs_"):
+            mtype, snooping, query = name[3:], True, False
+        elif name.startswith("h_"):
+            mtype, snooping, query = name[2:], False, False
+        else:
+            continue
+        
+        if name=="h_default":
+            continue
+        
+        attr=getattr(cls, name)
+        if not callable(attr):
+            continue
+        
+        entry=table.get(mtype, None)
+        if entry is not None and snooping and not entry[1]:
+            continue
+        
+        table[mtype]=(getattr(attr, "im_func", attr), snooping, query, None)
+        
+    for mtype, bhandler in batch.iteritems():
+        handler, snooping, query, _ = table.get(mtype, (None, False, False, None))
+        table[mtype]=(handler, snooping, query, bhandler)
+        
+    default=getattr(cls, "h_default", None)
+    default=getattr(default, "im_func", default)
+        
+    return (table, default)
+
+
+def declared_interests(table, default):
+    """
+    Computes the static interest declaration from a dispatch table
+    
+    An Agent with a catch-all handler can't declare its interests
+    statically: it relies on the dynamic "__interest__" protocol.
+    
+    @return None or {mtype: snooping}
+    """
+    if default is not None:
+        return None
+    
+    interests={"__quit__": False}
+    for mtype, (_handler, snooping, _query, _bhandler) in table.iteritems():
+        interests[mtype]=snooping
+    return interests
+
+
+class AgentType(type):
+    """
+    Metaclass for Agents: compiles the dispatch table once per class
+    
+    The default handler is stored as a plain class attribute: it is
+    thus retrieved as a bound method.
+    """
+    def __init__(cls, name, bases, dct):
+        type.__init__(cls, name, bases, dct)
+        cls._dispatch, cls._default_handler = compile_dispatch(cls)
+        cls._interests = declared_interests(cls._dispatch, cls._default_handler)
+
+
 def mdispatch(obj, this_source, envelope):
     """
     Dispatches a message to the target
     handler inside a class instance
     
+    The class must have been compiled through 'AgentType'
+    
+    A batch (see mswitch.publish_many) is handed as a whole to the
+    batch handler "hb_<mtype>" if there is one, else it is unpacked
+    into individual handler calls.
+    
     @return (__quit__, mtype, handled, snooping)
     
     handled:  None  --> rejected because sending to self
@@ -41,12 +148,6 @@ def mdispatch(obj, this_source, envelope):
     """
     orig, mtype, payload = envelope
     
-    ## on snooping handlers...
-    try:    pargs, kargs = payload
-    except: 
-        pargs=()
-        kargs=()
-    
     ## Avoid sending to self -- shouldn't occur at this point anyways
     if orig == this_source:
         print "************* mdispatch: dropped: orig(%s) obj_orig(%s) mtype(%s)" % (orig, this_source, mtype)
@@ -55,75 +156,76 @@ def mdispatch(obj, this_source, envelope):
     if mtype=="__quit__":
         return (True, mtype, None, False)
 
-    handled=False
-    snoopingHandler=False
-
-    if mtype.endswith("?"):
-        handlerName="hq_%s" % mtype[:-1]
-        sHandlerName="hqs_%s" % mtype[:-1]
-    else:
-        handlerName="h_%s" % mtype
-        sHandlerName="hs_%s" % mtype
+    entry=obj._dispatch.get(mtype, None)
+    if entry is None:
+        handler=obj._default_handler
+        if handler is None:
+            return (False, mtype, False, False)
         
-    handler =getattr(obj, handlerName, None)
-    shandler=getattr(obj, sHandlerName, None)    
-    
-    if handler is None:
-        if shandler is not None:
-            snoopingHandler=True
-            handler=shandler
-    
-    if handler is None:
-        handler=getattr(obj, "h_default", None)    
-        if handler is not None:
-            handler(mtype,*pargs, **kargs)
-            handled=True
-    else:
-        handled=True
-        if snoopingHandler:
-            handler()
+        ## on snooping handlers...
+        if payload is None:
+            handler(mtype)
+        elif type(payload) is mswitch.Batch:
+            for pargs in payload:
+                handler(mtype, *pargs)
+        else:
+            pargs, kargs = payload
+            handler(mtype, *pargs, **kargs)
+        return (False, mtype, True, False)
+
+    handler, snooping, _query, bhandler = entry
+    if type(payload) is mswitch.Batch:
+        if bhandler is not None:
+            bhandler(obj, payload)
+        elif snooping:
+            for _ in payload:
+                handler(obj)
         else:
-            handler(*pargs, **kargs)
+            for pargs in payload:
+                handler(obj, *pargs)
+    elif handler is None:
+        ## only a batch handler: batch of 1
+        bhandler(obj, mswitch.Batch((payload[0],)))
+    elif snooping:
+        handler(obj)
+    else:
+        pargs, kargs = payload
+        handler(obj, *pargs, **kargs)
 
-    return (False, mtype, handled, snoopingHandler)
+    return (False, mtype, True, snooping)
 
 
 def process_queues(src_agent, agent_name, agent_id, interest_map, responsesInterestList,
-                   iq, isq, processor, low_priority_burst_size=5):
+                   mbox, processor, low_priority_burst_size=5, block=True):
     """
-    Runs through both queues and calls processing on valid messages
+    Runs through the mailbox and calls processing on valid messages
+    
+    The high priority messages are always served first by the mailbox:
+    a maximum of 'low_priority_burst_size' normal messages are processed
+    per call.
+    
+    @param block: True to sleep until the first message arrives
     """
-    quit=False
+    burst=low_priority_burst_size
     while True:
         try:
-            envelope=isq.get(block=True, timeout=0.1)
-            mquit=processor(src_agent, agent_name, agent_id, interest_map, responsesInterestList, iq, isq, envelope)
-            if mquit:
-                quit=True
-                break
-            continue
+            envelope=mbox.get(block)
         except Empty:
-            break
+            return False
         
-
-    burst=low_priority_burst_size
-    while True and not quit:                
-        try:
-            envelope=iq.get(block=False)#(block=True, timeout=0.1)
-            mquit=processor(src_agent, agent_name, agent_id, interest_map, responsesInterestList, iq, isq, envelope)
-            if mquit:
-                quit=True
-                break
-
+        ## only wait for the first one
+        block=False
+        
+        mquit=processor(src_agent, agent_name, agent_id, interest_map, responsesInterestList, mbox, envelope)
+        if mquit:
+            return True
+        
+        if not envelope[1].startswith("__"):
             burst -= 1
             if burst == 0:
-                break
-        except Empty:
-            break
+                return False
     
-    return quit
-    
-def message_processor(src_agent, agent_name, agent_id, interest_map, responsesInterestList, iq, isq, envelope):
+def message_processor(src_agent, agent_name, agent_id, interest_map, responsesInterestList, mbox, envelope):
     """
     Processes 1 message envelope
     
@@ -150,7 +252,7 @@ def message_processor(src_agent, agent_name, agent_id, interest_map, responsesIn
     if interested is None:
         if mtype!="__quit__":
             if mtype not in responsesInterestList:
-                mswitch.publish(agent_id, "__interest__", agent_name, agent_id, mtype, handled, snooping, iq, isq)
+                mswitch.publish(agent_id, "__interest__", agent_name, agent_id, mtype, handled, snooping, mbox)
                 responsesInterestList.append(mtype)
 
                 ## stop sending to self definitely
@@ -166,18 +268,36 @@ def message_processor(src_agent, agent_name, agent_id, interest_map, responsesIn
 class AgentThreadedBase(Thread):
     """
     Base class for Agent running in a 'thread' 
+    
+    Mailbox declaration:
+    ====================
+    - MAILBOX_SIZE : capacity for normal priority messages, 0 for unbounded
+    - MAILBOX_POLICIES : {mtype: policy} applied when the mailbox is full
+    - MAILBOX_DEFAULT_POLICY : for the message types not in MAILBOX_POLICIES
+    - MAILBOX_COALESCE : {mtype: None or index of key argument} for the
+                         message types where only the latest pending one matters
+    
+    See app.system.mailbox for the available policies.
     """
+    __metaclass__=AgentType
     
     LOW_PRIORITY_BURST_SIZE=5
     
+    MAILBOX_SIZE=0
+    MAILBOX_POLICIES={}
+    MAILBOX_DEFAULT_POLICY=BLOCK
+    MAILBOX_COALESCE={}
+    
     def __init__(self, debug=False):
         Thread.__init__(self)
-        self.mmap={}
+        
+        ## nothing left to find out when interests are declared
+        self.mmap=dict.fromkeys(self._interests or (), True)
         
         self.debug=debug
         self.id = uuid.uuid1()
-        self.iq = Queue()
-        self.isq= Queue()
+        self.mbox=Mailbox(self.MAILBOX_SIZE, self.MAILBOX_POLICIES, 
+                          self.MAILBOX_DEFAULT_POLICY, self.MAILBOX_COALESCE)
         
         self.agent_name=str(self.__class__).split(".")[-1][:-2]
         self.responsesInterest=[]
@@ -189,23 +309,27 @@ class AgentThreadedBase(Thread):
     def pub(self, msgType, *pargs, **kargs):
         mswitch.publish(self.id, msgType, *pargs, **kargs)
         
+    def pub_many(self, msgType, iargs):
+        mswitch.publish_many(self.id, msgType, iargs)
+        
     def run(self):
         """
         Main Loop
         """
         print "Agent(%s) (%s) starting" % (self.agent_name, self.id)
         
-        ## subscribe this agent to all
-        ## the messages of the switch.
-        ## Later on when the agent starts receiving messages,
-        ## it will signal which 'message types' are of interest.
-        mswitch.subscribe(self.id, self.iq, self.isq)
+        ## subscribe this agent to the messages it can handle.
+        ## An agent with a catch-all handler is subscribed to all
+        ## the messages of the switch: later on when it starts receiving
+        ## messages, it will signal which 'message types' are of interest.
+        mswitch.subscribe(self.id, self.mbox, self._interests)
         
         quit=False
         while not quit:
             quit=process_queues(self, self.agent_name, self.id, 
                                 self.mmap, self.responsesInterest,
-                                self.iq, self.isq, message_processor)
+                                self.mbox, message_processor,
+                                self.LOW_PRIORITY_BURST_SIZE)
             
         print "Agent(%s) (%s) ending" % (self.agent_name, self.id)
                 
@@ -224,7 +348,13 @@ class AgentThreadedWithEvents(AgentThreadedBase):
         E.g.
         ("sec", 2, callback) : will fire "callback" every 2 seconds
         ("min", 5, callback) : will fire "callback" every 5 minutes
+        
+    The timers are registered once with the timers service (app.system.timers)
+    when the Agent starts: only the due callbacks are delivered, as "__timer__"
+    messages. A late "__timer__" is superseded by the next one for the same callback.
     """
+    MAILBOX_COALESCE={"__timer__": 2}
+    
     def __init__(self, timers_spec=[], debug=False):
         AgentThreadedBase.__init__(self, debug)
         
@@ -232,7 +362,6 @@ class AgentThreadedWithEvents(AgentThreadedBase):
         except: ts=[]
         
         self.timers_spec=timers_spec or ts
-        self._timers={"sec":[], "min": [], "hour":[], "day": []}
 
         try:        
             self._processTimersSpec()
@@ -241,38 +370,25 @@ class AgentThreadedWithEvents(AgentThreadedBase):
         
     def _processTimersSpec(self):
         """
-        Process the timers_spec required for the Agent
+        Verifies the timers_spec required for the Agent
         """
         for timer in self.timers_spec:
             base, interval, callback_name=timer
-            entries=self._timers.get(base, [])
-            entries.append((interval, callback_name))
+            if base not in timers.UNITS or interval<=0:
+                raise ValueError(timer)
+            if not callable(getattr(self, callback_name)):
+                raise ValueError(timer)
         
+    def run(self):
+        timers.register(self.mbox, self.timers_spec)
+        AgentThreadedBase.run(self)
         
-    def h___tick__(self, _ticks_per_second, 
-               second_marker, min_marker, hour_marker, day_marker,
-               sec_count, min_count, hour_count, day_count):
+    def h___timer__(self, base, count, callback_name):
         """
         CRON like support
         """
-        #print "%s: __tick__" % (self.__class__,)
-        #print "h_tick: sec_count(%s) min_count(%s) hour_count(%s) day_count(%s)" % (sec_count, min_count, hour_count, day_count)
-        #print "h_tick: sec(%s) min(%s) hour(%s) day(%s)" % (second_marker, min_marker, hour_marker, day_marker)
-        if second_marker:
-            self._processTimers(sec_count, "sec")
-        if min_marker:
-            self._processTimers(min_count, "min")
-        if hour_marker:
-            self._processTimers(hour_count, "hour")
-        if day_marker:
-            self._processTimers(day_count, "day")
-        
-    def _processTimers(self, count, base):
-        for entry in self._timers[base]:
-            interval, callback_name = entry
-            if (count % interval==0):
-                callback=getattr(self, callback_name)
-                callback(base, count)
+        callback=getattr(self, callback_name)
+        callback(base, count)
                 
 
                 
@@ -329,106 +445,3 @@ class TickGenerator(object):
         
         ## just in case this is used along with gobject...
         return True
-    
-    
-def custom_dispatch(source, q, pq, dispatcher, low_priority_burst_size=5):
-    """
-    For customer dispatching
-    
-    @param source: identifier for 'source'
-    @param low_priority_burst_size: integer, maximum size of normal queue processing at a time 
-    @param q: normal queue
-    @param pq: priority queue
-    @param dispatcher: callable
-    """
-    while True:
-        try:     
-            envelope=pq.get(False)
-            orig, mtype, payload = envelope
-            pargs, _kargs = payload
-            
-            ## skip self
-            if orig==source:
-                continue
-            handled, snooping=dispatcher(mtype, *pargs)
-            if handled==False:
-                ## low overhead - once per run
-                print "* '%s': not interest in '%s' message type" % (orig, mtype)
-                mswitch.publish(source, "__interest__", source, mtype, False, snooping, q, pq)
-                break
-        except Empty:
-            break
-        continue            
-    
-    burst=low_priority_burst_size
-    
-    while True:
-        try:     
-            envelope=q.get(False)
-            orig, mtype, payload = envelope
-            pargs, _kargs = payload
-
-            ## skip self
-            if orig==source:
-                continue
-            handled, snooping=dispatcher(mtype, *pargs)
-            if handled==False:
-                ## low overhead - once per run
-                print "* '%s': not interest in '%s' message type" % (orig, mtype)
-                mswitch.publish(source, "__interest__", source, mtype, False, snooping, q, pq)
-            burst -= 1
-            if burst == 0:
-                break
-        except Empty:
-            break
-        
-        continue
-    
-
-def dispatcher(source, q, pq, low_priority_burst_size=5):
-    """
-    Message dispatcher
-    """
-    while True:
-        try:     
-            envelope=pq.get(False)
-            orig, mtype, payload = envelope
-            pargs, _kargs = payload
-            
-            ## skip self
-            if orig==source:
-                continue
-            handled, snooping=dispatcher(mtype, *pargs)
-            if handled==False:
-                ## low overhead - once per run
-                print "* '%s': not interest in '%s' message type" % (orig, mtype)
-                mswitch.publish(source, "__interest__", source, mtype, False, snooping, pq)
-                break
-        except Empty:
-            break
-        continue            
-    
-    burst=low_priority_burst_size
-    
-    while True:
-        try:     
-            envelope=q.get(False)
-            orig, mtype, payload = envelope
-            pargs, _kargs = payload
-
-            ## skip self
-            if orig==source:
-                continue
-            handled, snooping=dispatcher(mtype, *pargs)
-            if handled==False:
-                ## low overhead - once per run
-                print "* '%s': not interest in '%s' message type" % (orig, mtype)
-                mswitch.publish(source, "__interest__", source, mtype, False, snooping, q)
-            burst -= 1
-            if burst == 0:
-                break
-        except Empty:
-            break
-        
-        continue
-    
@@ -0,0 +1,92 @@
+"""
+    Bloom filter - set membership with no false negatives
+
+    * 'key in filter' False: the key was never added
+    * 'key in filter' True: the key was probably added, with a
+      false positive probability depending on the fill level
+    * keys are strings or tuples of strings
+
+    The filter is sized for a 'capacity' at a target false positive rate:
+    beyond its capacity the rate degrades and the filter should be rebuilt
+    (see 'full').
+
+    The k bit positions are derived from one md5 digest
+    (double hashing: h1 + i*h2).
+
+    Usage:
+        bf=BloomFilter(capacity=100000, error_rate=0.01)
+        bf.add(("artist", "album", "track"))
+        ("artist", "album", "track") in bf
+
+    Created on 2010-09-07
+    @author: jldupont
+"""
+import hashlib
+import math
+import struct
+
+__all__=["BloomFilter"]
+
+
+class BloomFilter(object):
+    """
+    @param capacity: expected count of keys
+    @param error_rate: target false positive rate at capacity
+    """
+    def __init__(self, capacity=10000, error_rate=0.01):
+        self.capacity=max(1, capacity)
+        self.error_rate=error_rate
+
+        ## optimal sizing: m=-n*ln(p)/ln(2)^2, k=m/n*ln(2)
+        self.nbits=int(math.ceil(-self.capacity*math.log(error_rate)/(math.log(2)**2)))
+        self.nhashes=max(1, int(round(float(self.nbits)/self.capacity*math.log(2))))
+        self.bits=bytearray((self.nbits+7)//8)
+        self.count=0
+
+    def _positions(self, key):
+        if isinstance(key, tuple):
+            key="\x00".join(key)
+        if isinstance(key, unicode):
+            key=key.encode("utf-8")
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        nbits=self.nbits
+        return [(h1+i*h2) % nbits for i in xrange(self.nhashes)]
+
+    def add(self, key):
+        """
+        @return True if the key was (probably) already present
+        """
+        present=True
+        bits=self.bits
+        for position in self._positions(key):
+            mask=1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                present=False
+                bits[position >> 3] |= mask
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self, key):
+        bits=self.bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        """
+        Count of distinct keys added - approximately: a key colliding
+        with previous ones isn't counted
+        """
+        return self.count
+
+    def full(self):
+        return self.count>=self.capacity
+
+    def fp_rate(self):
+        """
+        Expected false positive rate at the current fill level: (1-e^(-kn/m))^k
+        """
+        k=self.nhashes
+        return (1.0-math.exp(-float(k)*self.count/self.nbits))**k
@@ -1,38 +1,206 @@
 """
     Database helpers
+    
+    Natural key:
+    ============
+    A table can be declared with a 'natural key' i.e. a list of columns
+    uniquely identifying a row: a unique index is maintained and the
+    'upsert' operation becomes available.
+    
+    Indexes:
+    ========
+    Secondary indexes are declared as a list of (name, columns, where):
+    
+        [("updated", ["updated", "id"], None)
+        ,("mbid_pending", ["id"], "track_mbid=''")   ## partial index
+        ]
+    
+    The indexes are created at startup and verified against their
+    declaration: an index whose definition changed is rebuilt.
+    
+    Schema versioning:
+    ==================
+    The version of each table is recorded in the "schema_version" table.
+    Migrations are declared as a list of (version, step) and applied
+    in order, at startup, to the existing tables: a step is an SQL
+    statement, a list of statements or a callable receiving the cursor.
+    
+        [(1, "ALTER TABLE ratings_cache ADD COLUMN attempts integer DEFAULT 0")
+        ]
+    
+    The 'create' declaration must always reflect the latest version:
+    a new table is created directly at that version.
+    
+    Named statements:
+    =================
+    The statements an Agent uses are declared once per table, as
+    {name: sql} with "%(table)s" standing for the table name, and
+    precomposed: the same string is handed to sqlite on each call
+    which makes the most of the connection's statement cache.
+    
+        {"mbid_pending": "SELECT * FROM %(table)s WHERE track_mbid='' LIMIT ?"}
+        
+        dbh.executeNamed("mbid_pending", 200)
+    
+    Rows:
+    =====
+    - tuples: fetchOne / fetchAll - the fast path, select the columns needed
+    - sqlite3.Row: executeRows - built in C, accessed by name or index,
+      to be consumed within the Agent
+    - dicts: fetchOneEx / fetchAllEx - keyed by the columns of the statement,
+      safe to hand over to another Agent
+    
+    The iterChunks / iterAll / iterAllEx generators stream the result set in chunks
+    (cursor.fetchmany) instead of materializing it: the cursor must not be
+    used for another statement until the iteration is over.
+    
+    Keyset pagination:
+    ==================
+    The rows are paged in (updated DESC, id DESC) order: a page starts
+    right after the last row of the previous page, identified by a
+    continuation token "updated:id", instead of skipping the rows
+    of all the previous pages. Requires an index on (updated, id).
+    
+    The token None stands for both ends of the walk: the first page
+    is requested with None and None is returned after the last page.
+    
+        rows, token=dbh.getPageAfter(None, 100)
+        rows, token=dbh.getPageAfter(token, 100)   ## token None: no more rows
+        
+        ## streamed, only the columns needed
+        for rows, token in dbh.iterPageAfter(token, 1000, ["source", "rating"]):
+            ...
+    
+    Tuning profile:
+    ===============
+    A list of (pragma, value) applied, in order, when connecting.
+    The default profile suits our workload: several connections
+    (one per Agent) to the same file, frequent small transactions.
+    
+    - WAL journal: the readers don't block the writer & vice-versa
+    - synchronous NORMAL: no fsync per commit in WAL mode, still safe
+      against application crashes
+    - busy_timeout: wait for a lock instead of failing with "database is locked"
         
     Created on 2010-08-19
     @author: jldupont
 """
-import copy
+from itertools import izip
 import os
 import sqlite3
 
-__all__=["dbHelper"]
+__all__=["dbHelper", "make_token", "parse_token", "MAX_ID", "DEFAULT_PROFILE", "STATEMENT_CACHE_SIZE", "apply_profile", "UPSERT_INSERTED", "UPSERT_UPDATED", "UPSERT_UNCHANGED"]
+
+UPSERT_INSERTED="inserted"
+UPSERT_UPDATED="updated"
+UPSERT_UNCHANGED="unchanged"
+
+## INSERT ... ON CONFLICT DO UPDATE
+NATIVE_UPSERT=sqlite3.sqlite_version_info >= (3, 24, 0)
+
+## per connection: sqlite3 defaults to 100
+STATEMENT_CACHE_SIZE=256
+
+DEFAULT_PROFILE=[("busy_timeout",  10000)     ## ms - first: the WAL switch needs a lock
+                 ,("journal_mode", "WAL")
+                 ,("synchronous",  "NORMAL")
+                 ,("temp_store",   "MEMORY")
+                 ,("cache_size",   -8000)      ## KiB
+                 ,("mmap_size",    67108864)   ## bytes
+                 ]
+
+## keyset start: all the rows up to a given 'updated'
+MAX_ID=2**63-1
+
+def make_token(updated, id):
+    """
+    Continuation token of a page ending with row (updated, id)
+    
+    'updated' can be any number (e.g. long, Dbus integer): its repr isn't relied upon
+    """
+    return "%r:%d" % (float(updated), id)
+
+def parse_token(token):
+    """
+    @return (updated, id)
+    @raise RuntimeError: invalid token
+    """
+    try:
+        updated, id = token.split(":")
+        return (float(updated), int(id))
+    except:
+        raise RuntimeError("invalid continuation token: %s" % token)
+
+
+def apply_profile(cursor, profile):
+    """
+    Applies a tuning profile
+    
+    A pragma the sqlite library doesn't support is ignored by sqlite itself.
+    """
+    for pragma, value in profile:
+        cursor.execute("""PRAGMA %s=%s""" % (pragma, value))
+        
+        ## some pragmas report the resulting setting
+        cursor.fetchall()
+
 
 class DbHelper(object):
     
-    def __init__(self, dbpath, table_name, table_params):
+    BUILTIN_STATEMENTS={"delete_by_id":     """DELETE FROM %(table)s WHERE id=?"""
+                        ,"row_count":      """SELECT Count(*) FROM %(table)s"""
+                        ,"page":           """SELECT * FROM %(table)s ORDER BY updated DESC LIMIT ?"""
+                        ,"latest_updated": """SELECT * FROM %(table)s ORDER BY updated DESC LIMIT 1"""
+                        }
+    
+    ## keyset pagination - composed per list of columns
+    PAGE_AFTER_TEMPLATE="""SELECT id, updated, %(columns)s FROM %(table)s WHERE updated<=? AND (updated<? OR id<?) 
+                                ORDER BY updated DESC, id DESC LIMIT ?"""
+    
+    ## rows per fetchmany
+    FETCH_CHUNK=100
+    
+    def __init__(self, dbpath, table_name, table_params, natural_key=None, indexes=None, migrations=None,
+                 profile=None, statements=None):
         self.dbpath=dbpath
         self.table_name=table_name
         self.table_params=table_params
+        self.natural_key=list(natural_key or [])
+        self.indexes=list(indexes or [])
+        self.migrations=list(migrations or [])
+        self.profile=DEFAULT_PROFILE if profile is None else profile
+        self.statement_templates=dict(self.BUILTIN_STATEMENTS)
+        self.statement_templates.update(statements or {})
         self.fields=[]
         self.emptyDicTemplate={}
+        self.upserts={}
         
         self.path=os.path.expanduser(self.dbpath)
-        self.conn=sqlite3.connect(self.path, check_same_thread=False)
+        self.conn=sqlite3.connect(self.path, check_same_thread=False, 
+                                  cached_statements=STATEMENT_CACHE_SIZE)
         self.c = self.conn.cursor()
+        
+        self.rc = self.conn.cursor()
+        self.rc.row_factory=sqlite3.Row
 
+        self._applyProfile()
         self._prepare()
         self._prepareEmptyDict()
-        self._executeCreate()
+        self._setup()
         
 
+    def _applyProfile(self):
+        apply_profile(self.c, self.profile)
+
     CREATE_STATEMENT_TEMPLATE="""create table if not exists %(table)s ( %(columns)s )"""
+    INDEX_STATEMENT_TEMPLATE="""CREATE INDEX %(name)s ON %(table)s (%(columns)s)"""
     def _prepare(self):
         """
         - Prepares the "create" statement
         - Prepars the "fields" list
+        - Prepares the "index" statements
+        - Precomposes the named statements
+        - Computes the schema signature
         """
         cols=""
         for entry in self.table_params:
@@ -45,22 +213,170 @@ class DbHelper(object):
         
         self.create_statement = self.CREATE_STATEMENT_TEMPLATE % ({"table":self.table_name, "columns": cols})
         
-    def _executeCreate(self):
-        self.c.execute(self.create_statement)
+        self.statements={}
+        for name, template in self.statement_templates.iteritems():
+            self.statements[name]=template % {"table": self.table_name}
+        
+        self.index_statements=[]
+        for name, columns, where in self.indexes:
+            index_name="%s_%s" % (self.table_name, name)
+            statement=self.INDEX_STATEMENT_TEMPLATE % {"name":    index_name
+                                                       ,"table":  self.table_name
+                                                       ,"columns": ", ".join(columns)}
+            if where:
+                statement += " WHERE %s" % where
+            self.index_statements.append((index_name, statement))
+        
+        self.target_version=max([version for version, _step in self.migrations] or [0])
+        self.signature="\n".join([self.create_statement, ", ".join(self.natural_key)]
+                                 +[statement for _name, statement in self.index_statements])
+        
+    def _setup(self):
+        """
+        Brings the table to its declared schema
+        
+        Fast path: nothing to do when the recorded version & signature are current
+        and the declared indexes are all present (e.g. none was dropped by hand).
+        Else, in one transaction:
+        - create the table (a new table is created at the latest version)
+        - apply the pending migrations, in order, to an existing table
+        - create the natural key & secondary indexes
+        - record the version
+        
+        @raise RuntimeError: the transaction is rolled back
+        """
+        self.c.execute(self.SCHEMA_TABLE_STATEMENT)
+        self.c.execute("""SELECT version, signature FROM schema_version WHERE table_name=?""", (self.table_name,))
+        row=self.c.fetchone()
+        if row is not None and row[0]>=self.target_version and row[1]==self.signature:
+            if self._indexesPresent():
+                return
+        current=0 if row is None else row[0]
+        
+        ## the sqlite3 module would commit implicitly before each DDL statement
+        isolation_level=self.conn.isolation_level
+        self.conn.isolation_level=None
+        try:
+            self.c.execute("BEGIN IMMEDIATE")
+            try:
+                self.c.execute("""SELECT name FROM sqlite_master WHERE type='table' AND name=?""", (self.table_name,))
+                existed=self.c.fetchone() is not None
+                
+                self.c.execute(self.create_statement)
+                if existed:
+                    self._executeMigrations(current)
+                self._executeNaturalKey()
+                self._executeIndexes()
+                
+                self.c.execute("""INSERT OR REPLACE INTO schema_version (table_name, version, signature)
+                                    VALUES (?, ?, ?)""", (self.table_name, 
+                                                          max(current, self.target_version), 
+                                                          self.signature))
+                self.c.execute("COMMIT")
+            except Exception,e:
+                self.c.execute("ROLLBACK")
+                raise RuntimeError("schema setup failed for table '%s' (%s)" % (self.table_name, e))
+        finally:
+            self.conn.isolation_level=isolation_level
+            
+    SCHEMA_TABLE_STATEMENT="""create table if not exists schema_version ( 
+                                table_name text primary key, version integer, signature text )"""
+        
+    def _executeMigrations(self, current):
+        """
+        Applies the migrations more recent than 'current' - in version order
+        
+        A migration step is either an SQL statement, a list of SQL statements
+        or a callable receiving the cursor.
+        """
+        for version, step in sorted(self.migrations, key=lambda migration: migration[0]):
+            if version<=current:
+                continue
+            if callable(step):
+                step(self.c)
+                continue
+            if isinstance(step, basestring):
+                step=[step]
+            for statement in step:
+                self.c.execute(statement)
+        
+    def _executeNaturalKey(self):
+        """
+        Creates the unique index on the natural key
+        
+        The duplicate rows of an existing table are removed
+        first: the most recent row (highest rowid) is kept.
+        """
+        if not self.natural_key:
+            return
         
-    def makeDict(self, ituple):
+        index_name="%s_natural_key" % self.table_name
+        self.c.execute("""SELECT name FROM sqlite_master WHERE type='index' AND name=?""", (index_name,))
+        if self.c.fetchone() is not None:
+            return
+        
+        columns=", ".join(self.natural_key)
+        self.c.execute("""DELETE FROM %s WHERE rowid NOT IN 
+                            (SELECT MAX(rowid) FROM %s GROUP BY %s)""" % (self.table_name, self.table_name, columns))
+        self.c.execute("""CREATE UNIQUE INDEX IF NOT EXISTS %s ON %s (%s)""" % (index_name, self.table_name, columns))
+        
+    def _indexesPresent(self):
+        """
+        Checks that the declared indexes (natural key included) exist - by name
+        """
+        declared=set([index_name for index_name, _statement in self.index_statements])
+        if self.natural_key:
+            declared.add("%s_natural_key" % self.table_name)
+        if not declared:
+            return True
+        
+        self.c.execute("""SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=?""", (self.table_name,))
+        existing=set([name for (name,) in self.c.fetchall()])
+        return declared <= existing
+        
+    def _executeIndexes(self):
+        """
+        Creates the declared indexes & verifies the existing ones
+        
+        The statistics of the query planner are refreshed
+        when an index was (re)built.
+        """
+        if not self.index_statements:
+            return
+        
+        self.c.execute("""SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=?""", (self.table_name,))
+        existing=dict(self.c.fetchall())
+        
+        changed=False
+        for index_name, statement in self.index_statements:
+            current=existing.get(index_name, None)
+            if current is not None:
+                if " ".join(current.split())==statement:
+                    continue
+                self.c.execute("""DROP INDEX %s""" % index_name)
+            self.c.execute(statement)
+            changed=True
+            
+        if changed:
+            self.c.execute("""ANALYZE %s""" % self.table_name)
+        
+    def makeDict(self, ituple, names=None):
+        """
+        @param names: column names, defaults to the table's fields
+        """
         if ituple is None:
             return {}
-        dic={}
-        index=0
-        for el in ituple:
-            key=self.fields[index]
-            dic[key]=el
-            index += 1
-        return dic
+        return dict(izip(names or self.fields, ituple))
         
     def makeEmptyDict(self):
-        return copy.deepcopy(self.emptyDicTemplate)
+        ## flat template of immutable values: a shallow copy suffices
+        return dict(self.emptyDicTemplate)
+        
+    def _columnNames(self):
+        """
+        Column names of the last statement executed
+        """
+        return [column[0] for column in self.c.description]
         
     def _prepareEmptyDict(self):
         """ Prepares an empty result dictionary
@@ -77,13 +393,12 @@ class DbHelper(object):
                 
                 
 
-    def deleteById(self, id):
-        self.c.execute("""DELETE * FROM %s 
-                            WHERE id=?""" % self.table_name, (id,))
+    def deleteById(self, id, cursor=None):
+        (cursor or self.c).execute(self.statements["delete_by_id"], (id,))
 
     def getRowCount(self):
         try: 
-            self.c.execute("""SELECT Count(*) FROM %s""" % self.table_name)
+            self.executeNamed("row_count")
             count=self.fetchOne(0)
         except:
             count=0
@@ -92,9 +407,120 @@ class DbHelper(object):
     def executeStatement(self, statement, *p):
         self.c.execute(statement, p)
         
+    def getStatement(self, name):
+        """
+        Retrieves a precomposed statement e.g. for use with the database writer's cursor
+        
+        @raise RuntimeError: unknown statement
+        """
+        try:
+            return self.statements[name]
+        except KeyError:
+            raise RuntimeError("unknown statement '%s' for table: %s" % (name, self.table_name))
+        
+    def executeNamed(self, name, *p):
+        self.c.execute(self.getStatement(name), p)
+        
+    def executeRows(self, name, *p):
+        """
+        Executes a named statement
+        
+        @return list of sqlite3.Row
+        """
+        self.rc.execute(self.getStatement(name), p)
+        return self.rc.fetchall()
+        
+    def upsert(self, values, compare=None, insert_only=(), cursor=None):
+        """
+        Inserts or updates the row identified by the natural key
+        
+        Uses 'INSERT ... ON CONFLICT DO UPDATE' when the sqlite library
+        supports it, preceded by a lookup of the natural key telling an
+        insert from an update, else 'UPDATE' followed if required 
+        by 'INSERT OR IGNORE'.
+        
+        The transaction isn't committed.
+        
+        @param values: {column: value} including the natural key columns
+        @param compare: columns which must differ for an existing row to be
+                        updated - defaults to all the updated columns
+        @param insert_only: columns only written upon insertion e.g. "created"
+        @param cursor: cursor to use instead of the helper's own e.g. the database writer's
+        
+        @return UPSERT_INSERTED, UPSERT_UPDATED or UPSERT_UNCHANGED
+        """
+        columns=tuple(sorted(values.keys()))
+        compare=tuple(compare or ())
+        insert_only=tuple(insert_only)
+        
+        spec=(columns, compare, insert_only)
+        statements=self.upserts.get(spec, None)
+        if statements is None:
+            statements=self._prepareUpsert(columns, compare, insert_only)
+            self.upserts[spec]=statements
+        
+        c=cursor or self.c
+        if NATIVE_UPSERT:
+            statement, names, probe=statements
+            
+            ## the rowids can't tell: a new row can get the rowid last inserted
+            ## (e.g. in another table) - the natural key index answers cheaply
+            c.execute(probe, [values[name] for name in self.natural_key])
+            existed=c.fetchone() is not None
+            c.execute(statement, [values[name] for name in names])
+            if c.rowcount<=0:
+                return UPSERT_UNCHANGED
+            if existed:
+                return UPSERT_UPDATED
+            return UPSERT_INSERTED
+            
+        update, update_names, insert, insert_names=statements
+        c.execute(update, [values[name] for name in update_names])
+        if c.rowcount>0:
+            return UPSERT_UPDATED
+        c.execute(insert, [values[name] for name in insert_names])
+        if c.rowcount>0:
+            return UPSERT_INSERTED
+        return UPSERT_UNCHANGED
+    
+    def _prepareUpsert(self, columns, compare, insert_only):
+        """
+        Prepares the upsert statement(s) for a set of columns
+        
+        @return (statement, parameter names, natural key lookup) for the native upsert
+            or  (update, update parameter names, insert, insert parameter names)
+        """
+        if not self.natural_key:
+            raise RuntimeError("no natural key declared for table: %s" % self.table_name)
+        
+        updated=[col for col in columns if col not in self.natural_key and col not in insert_only]
+        compare=compare or updated
+        
+        insert="""INSERT %%s INTO %s (%s) VALUES (%s)""" % (self.table_name, 
+                                                            ", ".join(columns), 
+                                                            ", ".join(["?"]*len(columns)))
+        if NATIVE_UPSERT:
+            statement=insert % "" + """ ON CONFLICT (%s) DO UPDATE SET %s WHERE %s""" % (
+                            ", ".join(self.natural_key),
+                            ", ".join(["%s=excluded.%s" % (col, col) for col in updated]),
+                            " OR ".join(["%s.%s IS NOT excluded.%s" % (self.table_name, col, col) for col in compare]))
+            probe="""SELECT 1 FROM %s WHERE %s LIMIT 1""" % (self.table_name,
+                            " AND ".join(["%s=?" % col for col in self.natural_key]))
+            return (statement, list(columns), probe)
+        
+        update="""UPDATE %s SET %s WHERE %s AND (%s)""" % (self.table_name,
+                            ", ".join(["%s=?" % col for col in updated]),
+                            " AND ".join(["%s=?" % col for col in self.natural_key]),
+                            " OR ".join(["%s IS NOT ?" % col for col in compare]))
+        update_names=updated+self.natural_key+list(compare)
+        return (update, update_names, insert % "OR IGNORE", list(columns))
+        
     def commit(self):
         self.conn.commit()
         
+    def rollback(self):
+        self.conn.rollback()
+        
     def rowCount(self):
         return self.c.rowcount
         
@@ -110,52 +536,146 @@ class DbHelper(object):
     
     def fetchOneEx(self, default=None):
         try:
-            entry=self.fetchOne()
-            data=self.makeDict(entry)
+            entry=self.c.fetchone()
         except:
-            data=default
-        return data
+            entry=None
+        if entry is None:
+            return default
+        return self.makeDict(entry, self._columnNames())
 
     def fetchOneEx2(self):
-        try:
-            entry=self.fetchOne()
-            data=self.makeDict(entry)
-        except:
-            data=self.makeEmptyDict()
-        return data
+        return self.fetchOneEx(None) or self.makeEmptyDict()
     
     def fetchAllEx(self, default=None):
-        result=[]
         try:
-            entries=self.fetchAll()
-            for entry in entries:
-                data=self.makeDict(entry)
-                result.append(data)
+            entries=self.c.fetchall()
+            names=self._columnNames()
         except:
-            result=default
-        return result
+            return default
+        return [dict(izip(names, entry)) for entry in entries]
+
+    def iterChunks(self, chunk=None):
+        """
+        Generator: rows of the last statement, as lists of tuples
+        
+        @param chunk: rows per fetch, defaults to FETCH_CHUNK
+        """
+        size=chunk or self.FETCH_CHUNK
+        while True:
+            rows=self.c.fetchmany(size)
+            if not rows:
+                return
+            yield rows
+            
+    def iterAll(self, chunk=None):
+        """
+        Generator: rows of the last statement, as tuples
+        """
+        for rows in self.iterChunks(chunk):
+            for row in rows:
+                yield row
+                
+    def iterAllEx(self, chunk=None):
+        """
+        Generator: rows of the last statement, as dicts
+        """
+        names=self._columnNames()
+        for row in self.iterAll(chunk):
+            yield dict(izip(names, row))
 
     def fetchAllEx2(self):
-        result=[]
-        try:
-            entries=self.fetchAll()
-            for entry in entries:
-                data=self.makeDict(entry)
-                result.append(data)
-        except:
-            result=[self.makeEmptyDict()]
+        result=self.fetchAllEx(None)
+        if result is None:
+            return [self.makeEmptyDict()]
         return result
 
     def getPage(self, limit=100):
-        statement="""SELECT * FROM %s 
-                        ORDER BY updated DESC LIMIT %s""" % (self.table_name, limit)
-        self.executeStatement(statement)
+        self.executeNamed("page", limit)
         return self.fetchAll()
     
+    def getPageAfter(self, token=None, limit=100, columns=None):
+        """
+        Keyset pagination on (updated, id)
+        
+        @param token: continuation token, None for the first page
+        @param columns: columns of the rows, defaults to all
+        @return (rows, token) - token is None after the last page
+        @raise RuntimeError: invalid token
+        """
+        rows=[]
+        next_token=None
+        for chunk, next_token in self.iterPageAfter(token, limit, columns):
+            rows.extend(chunk)
+        return (rows, next_token)
+    
+    def iterPageAfter(self, token=None, limit=100, columns=None, chunk=None, start=None):
+        """
+        Keyset pagination on (updated, id) - generator of (rows, token),
+        the page being streamed in chunks (see iterChunks)
+        
+        'token' is None but on the chunk completing a full page: it then
+        continues the walk.  A walk which ends before 'limit' rows (or yields
+        nothing) is exhausted.
+        
+        @param token: continuation token, None for the first page
+        @param columns: columns of the rows, defaults to all
+        @param chunk: rows per fetch, defaults to FETCH_CHUNK
+        @param start: (updated, id) to start after instead of a token e.g. (timestamp, MAX_ID)
+        @raise RuntimeError: invalid token
+        """
+        if start is not None:
+            updated, id = (float(start[0]), int(start[1]))
+        elif token is None:
+            updated, id = (float("inf"), MAX_ID)
+        else:
+            updated, id = parse_token(token)
+        
+        columns=tuple(columns or ("*",))
+        name="page_after:%s" % ",".join(columns)
+        statement=self.statements.get(name, None)
+        if statement is None:
+            statement=self.PAGE_AFTER_TEMPLATE % {"table":    self.table_name
+                                                  ,"columns": ", ".join(columns)}
+            self.statements[name]=statement
+            
+        self.c.execute(statement, (updated, updated, id, limit))
+        
+        ### rows: (id, updated, columns...)
+        count=0
+        for rows in self.iterChunks(chunk):
+            count += len(rows)
+            next_token=None
+            if count>=limit:
+                last=rows[-1]
+                next_token=make_token(last[1], last[0])
+            yield ([row[2:] for row in rows], next_token)
+    
     def getLatestUpdated(self):
-        statement="""SELECT * FROM %s 
-                        ORDER BY updated DESC LIMIT 1""" % self.table_name
-        self.executeStatement(statement)
-        return self.fetchOne()
+        self.executeNamed("latest_updated")
+        return self.fetchOneEx(None)
         
         
+
+
+if __name__=="__main__":
+    import tempfile
+    
+    path=os.path.join(tempfile.mkdtemp(), "upsert.sqlite")
+    dbh=DbHelper(path, "upsert_check", [("id", "integer primary key"), ("name", "text"), ("value", "float")], ["name"])
+    
+    ## a fresh connection: "schema_version" was just written to
+    assert dbh.upsert({"name": "a", "value": 1.0})==UPSERT_INSERTED
+    assert dbh.upsert({"name": "a", "value": 1.0})==UPSERT_UNCHANGED
+    assert dbh.upsert({"name": "a", "value": 2.0})==UPSERT_UPDATED
+    assert dbh.upsert({"name": "b", "value": 2.0})==UPSERT_INSERTED
+    dbh.commit()
+    print "upsert: OK"
+    
+    ## an index dropped on an existing install is recreated at startup
+    dbh=DbHelper(path, "upsert_check", [("id", "integer primary key"), ("name", "text"), ("value", "float")], ["name"],
+                 indexes=[("value", ["value"], None)])
+    dbh.c.execute("DROP INDEX upsert_check_value")
+    dbh=DbHelper(path, "upsert_check", [("id", "integer primary key"), ("name", "text"), ("value", "float")], ["name"],
+                 indexes=[("value", ["value"], None)])
+    assert dbh._indexesPresent()
+    print "indexes: OK"
@@ -0,0 +1,190 @@
+"""
+    Database writer service
+
+    * one writer thread & one write connection per database file
+    * the Agents submit 'work' i.e. a callable receiving the write cursor
+    * the pending work is grouped in one transaction: each work item
+      runs in its own savepoint so that a failing item only rolls back
+      its own changes
+    * the results are returned asynchronously, once committed,
+      as messages on the switch - never held back by the switch's
+      backpressure (see mswitch.UNTHROTTLED_SOURCES)
+    * a failing transaction (e.g. I/O error) fails its whole batch:
+      the writer carries on with the next one
+
+    The Agents keep their own DbHelper connection for reading:
+    in WAL mode the readers never wait on the writer.
+
+    Work:
+    =====
+        work(cursor, *args) -> result
+
+    Reply message:
+    ==============
+        "reply_mtype" (token, result, error)
+
+        error: None or the error description (the result is then None)
+
+    Usage:
+        dbservice.submit("~/musync.sqlite", work, args, "ratings_flushed", token)
+        
+        ## e.g. on shutdown: wait for the work submitted so far to be committed
+        dbservice.drain("~/musync.sqlite", timeout=5)
+
+    Created on 2010-09-06
+    @author: jldupont
+"""
+from threading import Thread, Lock, Event
+from Queue import Queue, Empty
+import os
+import sqlite3
+
+from app.system import mswitch
+from app.system.db import DEFAULT_PROFILE, STATEMENT_CACHE_SIZE, apply_profile
+
+__all__=["submit", "drain", "DB_SOURCE"]
+
+DB_SOURCE="__db__"
+
+
+class DbWriter(Thread):
+    """
+    Owns the write connection of one database file
+    """
+    ## maximum count of work items per transaction
+    MAX_BATCH=500
+
+    def __init__(self, path, profile=DEFAULT_PROFILE):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.path=path
+        self.profile=profile
+        self.queue=Queue()
+
+    def submit(self, work, args, reply_mtype, token, done=None):
+        """
+        @param done: Event set once the work is committed (or failed)
+        """
+        self.queue.put((work, args, reply_mtype, token, done))
+
+    def run(self):
+        cursor=None
+        while True:
+            batch=[self.queue.get()]
+            try:
+                while len(batch)<self.MAX_BATCH:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+
+            try:
+                if cursor is None:
+                    cursor=self._connect()
+                replies=self._execute(cursor, batch)
+            except Exception,e:
+                self._rollback(cursor)
+                replies=[(reply_mtype, token, None, "transaction error (%s)" % e)
+                         for _work, _args, reply_mtype, token, _done in batch]
+                
+            ## committed (or failed): 'drain' needn't wait for the replies
+            for _work, _args, _reply_mtype, _token, done in batch:
+                if done is not None:
+                    done.set()
+                    
+            for reply_mtype, token, result, error in replies:
+                if reply_mtype is not None:
+                    mswitch.publish(DB_SOURCE, reply_mtype, token, result, error)
+
+    def _connect(self):
+        ## autocommit mode: the transactions are managed explicitly
+        conn=sqlite3.connect(self.path, isolation_level=None, 
+                             cached_statements=STATEMENT_CACHE_SIZE)
+        cursor=conn.cursor()
+        apply_profile(cursor, self.profile)
+        return cursor
+
+    def _rollback(self, cursor):
+        """
+        Rolls back the current transaction, if any
+        """
+        if cursor is None:
+            return
+        try:
+            cursor.execute("ROLLBACK")
+        except Exception:
+            ## no transaction open
+            pass
+
+    def _execute(self, cursor, batch):
+        """
+        Runs a batch of work items in one transaction
+
+        @return [(reply_mtype, token, result, error)]
+        @raise sqlite3.Error: the transaction failed as a whole
+        """
+        replies=[]
+        cursor.execute("BEGIN IMMEDIATE")
+
+        for work, args, reply_mtype, token, _done in batch:
+            cursor.execute("SAVEPOINT work")
+            try:
+                result=work(cursor, *args)
+            except Exception,e:
+                cursor.execute("ROLLBACK TO work")
+                cursor.execute("RELEASE work")
+                replies.append((reply_mtype, token, None, str(e)))
+                continue
+            cursor.execute("RELEASE work")
+            replies.append((reply_mtype, token, result, None))
+
+        cursor.execute("COMMIT")
+        return replies
+
+
+## ===============================================================
+## =============================================================== API functions
+## ===============================================================
+
+_writers={}
+_writers_lock=Lock()
+
+
+def _writer(dbpath):
+    """
+    Retrieves the writer of 'dbpath' - started on first use
+    """
+    path=os.path.expanduser(dbpath)
+
+    _writers_lock.acquire()
+    try:
+        writer=_writers.get(path, None)
+        if writer is None:
+            writer=DbWriter(path)
+            writer.start()
+            _writers[path]=writer
+    finally:
+        _writers_lock.release()
+    return writer
+
+
+def submit(dbpath, work, args=(), reply_mtype=None, token=None):
+    """
+    Queues 'work' for the writer of 'dbpath'
+
+    @param work: callable(cursor, *args) returning the result
+    @param reply_mtype: message type of the reply, None for no reply
+    @param token: returned as-is in the reply
+    """
+    _writer(dbpath).submit(work, args, reply_mtype, token)
+
+
+def drain(dbpath, timeout=None):
+    """
+    Waits for the work submitted so far for 'dbpath' to be processed
+
+    @return False on timeout
+    """
+    done=Event()
+    _writer(dbpath).submit(lambda cursor: None, (), None, None, done)
+    done.wait(timeout)
+    return done.isSet()
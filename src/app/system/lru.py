@@ -0,0 +1,119 @@
+"""
+    LRU cache - bounded in entries and in (estimated) memory
+
+    * the least recently used entries are evicted first
+    * 'get' refreshes the entry
+    * hit / miss / eviction counters
+
+    The memory bound relies on an estimate of the size of each entry:
+    by default the length of the strings in the key & value plus a fixed
+    overhead per entry.
+
+    Usage:
+        cache=LruCache(max_entries=5000, max_bytes=2*1024*1024)
+        cache.put(key, value)
+        value=cache.get(key, None)
+
+    Created on 2010-09-07
+    @author: jldupont
+"""
+from collections import OrderedDict
+
+__all__=["LruCache", "estimate_size"]
+
+## dict slot, tuples, linked list node... roughly
+ENTRY_OVERHEAD=200
+
+
+def estimate_size(key, value):
+    """
+    Estimated memory footprint of an entry, in bytes
+    """
+    size=ENTRY_OVERHEAD
+    for part in (key, value):
+        if not isinstance(part, tuple):
+            part=(part,)
+        for element in part:
+            if isinstance(element, basestring):
+                size += len(element)
+            else:
+                size += 24
+    return size
+
+
+class LruCache(object):
+    """
+    @param max_entries: 0 for no limit
+    @param max_bytes: 0 for no limit
+    @param sizer: callable(key, value) returning the size of an entry
+    """
+    def __init__(self, max_entries=1000, max_bytes=0, sizer=estimate_size):
+        self.max_entries=max_entries
+        self.max_bytes=max_bytes
+        self.sizer=sizer
+
+        ## key -> (value, size)
+        self.entries=OrderedDict()
+        self.bytes=0
+
+        self.hits=0
+        self.misses=0
+        self.evictions=0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """
+        Retrieves & refreshes an entry
+        """
+        try:
+            entry=self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.entries[key]=entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        """
+        Inserts or replaces an entry, evicting as required
+        """
+        self.discard(key)
+
+        size=self.sizer(key, value)
+        self.entries[key]=(value, size)
+        self.bytes += size
+
+        while self.entries and ((self.max_entries and len(self.entries)>self.max_entries)
+                                or (self.max_bytes and self.bytes>self.max_bytes)):
+            _key, (_value, evicted_size) = self.entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+    def discard(self, key):
+        entry=self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes=0
+
+    def stats(self):
+        """
+        @return dict of the counters
+        """
+        lookups=self.hits+self.misses
+        return {"entries":    len(self.entries)
+                ,"bytes":     self.bytes
+                ,"hits":      self.hits
+                ,"misses":    self.misses
+                ,"evictions": self.evictions
+                ,"hit_ratio": float(self.hits)/lookups if lookups else 0.0
+                }
@@ -0,0 +1,296 @@
+"""
+    Mailbox - dual priority message queue
+
+    * one lock guarding two deques
+    * high priority items are always served first
+    * consumers block until work arrives: no polling / timeouts
+    * optional capacity on the normal priority lane with
+      per message type overflow policies
+    * optional coalescing of superseded messages
+
+    The 'get' method follows the semantics of Queue.get
+    i.e. 'Empty' is raised when no item is available in
+    non-blocking mode.
+
+    The items are message envelopes i.e. (orig, mtype, payload).
+
+    Overflow policies:
+    ==================
+    - "block"        : the publisher waits until there is room (see 'waitRoom')
+    - "drop_oldest"  : the oldest pending message is discarded
+    - "drop_newest"  : the message being queued is discarded
+    - "coalesce"     : the message replaces the most recent pending
+                       message of the same type (else drop_oldest)
+    
+    "drop_oldest" evicts the oldest pending message of the same type or,
+    failing that, of a type which may itself be dropped (i.e. not "block"):
+    with none of those pending, the message being queued is discarded.
+    A "block" message is never evicted.
+
+    The high priority lane (system messages) is never bounded.
+    
+    'put' never waits: it is called by the switch thread, which must keep
+    serving the other Agents.  For the "block" policy, the publisher waits
+    on its own thread, before handing the message to the switch, through
+    'waitRoom'.  A message reaching a full mailbox anyway (publisher gave up
+    waiting) is queued beyond the capacity.
+
+    Coalescing:
+    ===========
+    For message types representing a 'state snapshot', only the latest
+    message matters: a newly queued message of a coalescable type replaces
+    the pending one of the same type, in place, instead of piling up.
+    The replacement can optionally be restricted to the messages sharing
+    the same value for a given positional argument of the payload.
+
+    Created on 2010-09-02
+    @author: jldupont
+"""
+from threading import Condition, Lock
+from collections import deque
+from Queue import Empty
+import time
+
+__all__=["Mailbox", "Empty",
+         "BLOCK", "DROP_OLDEST", "DROP_NEWEST", "COALESCE"]
+
+BLOCK="block"
+DROP_OLDEST="drop_oldest"
+DROP_NEWEST="drop_newest"
+COALESCE="coalesce"
+
+
+class _Slot(list):
+    """
+    Queue entry of a coalescable message: its content gets replaced in place
+    """
+    def __init__(self, item, key):
+        list.__init__(self, item)
+        self.key=key
+
+
+class Mailbox(object):
+    """
+    Message queue with 'high' and 'normal' priority lanes
+
+    @param maxsize: capacity of the normal lane, 0 for unbounded
+    @param policies: dict of {mtype: policy}
+    @param default_policy: policy for the other message types
+    @param coalesce: dict of {mtype: None or index of the key argument}
+    """
+    def __init__(self, maxsize=0, policies=None, default_policy=BLOCK, coalesce=None):
+        self.lock=Lock()
+        self.cond=Condition(self.lock)
+        self.not_full=Condition(self.lock)
+        self.hq=deque()
+        self.q=deque()
+
+        self.maxsize=maxsize
+        self.policies=policies or {}
+        self.default_policy=default_policy
+
+        self.coalesce=coalesce or {}
+        
+        ## (mtype, key) -> pending _Slot
+        self.pending={}
+
+        ## mtype -> count of discarded messages
+        self.drops={}
+        
+        ## mtype -> count of superseded messages
+        self.coalesced={}
+
+    def __len__(self):
+        return len(self.hq)+len(self.q)
+
+    def put(self, item, high=False):
+        """
+        Queues 'item' and wakes up the consumer
+
+        @param high: True for the high priority lane
+        """
+        self.cond.acquire()
+        try:
+            if self.coalesce and item[1] in self.coalesce:
+                item=self._coalesce(item)
+                if item is None:
+                    return
+                
+            if high:
+                self.hq.append(item)
+            else:
+                if self.maxsize and len(self.q)>=self.maxsize:
+                    if not self._overflow(item):
+                        if type(item) is _Slot:
+                            del self.pending[item.key]
+                        return
+                self.q.append(item)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _coalesce(self, item):
+        """
+        Replaces the pending message superseded by 'item' - lock held
+
+        @return None if 'item' took the place of a pending message
+                else the entry to queue
+        """
+        orig, mtype, payload = item
+        
+        ## a batch is never superseded
+        if payload is not None and type(payload) is not tuple:
+            return item
+        
+        index=self.coalesce[mtype]
+        if index is None:
+            key=(mtype, None)
+        else:
+            try:    key=(mtype, payload[0][index])
+            except: return item
+
+        slot=self.pending.get(key, None)
+        if slot is not None:
+            slot[:]=item
+            self.coalesced[mtype]=self.coalesced.get(mtype, 0)+1
+            return None
+
+        slot=_Slot(item, key)
+        self.pending[key]=slot
+        return slot
+
+    def _unpack(self, item):
+        """
+        Unwraps a queue entry - lock held
+        """
+        if type(item) is _Slot:
+            del self.pending[item.key]
+            return tuple(item)
+        return item
+
+    def _overflow(self, item):
+        """
+        Applies the overflow policy - lock held
+
+        @return True if 'item' must still be queued
+        """
+        mtype=item[1]
+        policy=self.policies.get(mtype, self.default_policy)
+
+        if policy==BLOCK:
+            ## the publisher was throttled beforehand - see 'waitRoom'
+            return True
+
+        if policy==DROP_NEWEST:
+            self._drop(mtype)
+            return False
+
+        if policy==COALESCE:
+            for index in xrange(len(self.q)-1, -1, -1):
+                if self.q[index][1]==mtype:
+                    self._unpack(self.q[index])
+                    self.q[index]=item
+                    self._drop(mtype)
+                    return False
+
+        ## DROP_OLDEST and COALESCE without a pending message of the same type
+        index=self._evictable(mtype)
+        if index is None:
+            self._drop(mtype)
+            return False
+        old=self._unpack(self.q[index])
+        del self.q[index]
+        self._drop(old[1])
+        return True
+
+    def _evictable(self, mtype):
+        """
+        Finds the message to evict for one of type 'mtype' - lock held
+
+        @return index of the oldest message of type 'mtype', else of the
+                oldest message whose own policy allows dropping, else None
+        """
+        candidate=None
+        for index, entry in enumerate(self.q):
+            if entry[1]==mtype:
+                return index
+            if candidate is None and self.policies.get(entry[1], self.default_policy)!=BLOCK:
+                candidate=index
+        return candidate
+
+    def waitRoom(self, mtype, timeout=None):
+        """
+        Waits until the normal lane has room for a message of type 'mtype'
+        
+        Only applies to the "block" policy: the other policies make room themselves.
+        Not to be called from the switch thread.
+        
+        @return False on timeout
+        """
+        if not self.maxsize or self.policies.get(mtype, self.default_policy)!=BLOCK:
+            return True
+        
+        self.cond.acquire()
+        try:
+            if len(self.q)<self.maxsize:
+                return True
+            if timeout is None:
+                while len(self.q)>=self.maxsize:
+                    self.not_full.wait()
+                return True
+            
+            deadline=time.time()+timeout
+            while len(self.q)>=self.maxsize:
+                remaining=deadline-time.time()
+                if remaining<=0:
+                    return False
+                self.not_full.wait(remaining)
+            return True
+        finally:
+            self.cond.release()
+
+    def _drop(self, mtype):
+        self.drops[mtype]=self.drops.get(mtype, 0)+1
+
+    def get(self, block=True):
+        """
+        Retrieves the next item - high priority lane first
+
+        @raise Empty: when no item is available and block==False
+        """
+        self.cond.acquire()
+        try:
+            while not self.hq and not self.q:
+                if not block:
+                    raise Empty
+                self.cond.wait()
+
+            if self.hq:
+                return self._unpack(self.hq.popleft())
+
+            item=self._unpack(self.q.popleft())
+            if self.maxsize and len(self.q)<self.maxsize:
+                self.not_full.notifyAll()
+            return item
+        finally:
+            self.cond.release()
+
+
+if __name__=="__main__":
+    ## a question never evicts a message which must not be dropped
+    mbox=Mailbox(3, {"in_qrating": DROP_OLDEST})
+    for index in range(3):
+        mbox.put(("orig", "in_rating", index))
+    mbox.put(("orig", "in_qrating", 0))
+    assert mbox.drops=={"in_qrating": 1}
+    assert [item[1] for item in mbox.q]==["in_rating"]*3
+    
+    ## the oldest question goes first
+    mbox=Mailbox(3, {"in_qrating": DROP_OLDEST})
+    mbox.put(("orig", "in_rating", 0))
+    mbox.put(("orig", "in_qrating", 1))
+    mbox.put(("orig", "in_qrating", 2))
+    mbox.put(("orig", "in_qrating", 3))
+    assert mbox.drops=={"in_qrating": 1}
+    assert [item[2] for item in mbox.q]==[0, 2, 3]
+    print "overflow: OK"
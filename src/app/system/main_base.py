@@ -0,0 +1,74 @@
+"""
+    Base class for the Agent living in the main thread
+
+    Pumps the messages destined to the main thread: no dependency
+    on gtk so that it can be used on a plain GLib main loop
+    (headless mode) as well as by the UI Agent.
+
+    Usage:
+        gobject.timeout_add(time_base, agent.tick)
+
+    Created on 2010-09-04
+    @author: jldupont
+"""
+from app.system import mswitch
+from app.system.mailbox import Mailbox, BLOCK
+from app.system.base import AgentType, process_queues, message_processor
+
+__all__=["MainAgentBase"]
+
+class MainAgentBase(object):
+    __metaclass__=AgentType
+
+    LOW_PRIORITY_MESSAGE_BURST_SIZE=5
+
+    ## see AgentThreadedBase
+    MAILBOX_SIZE=0
+    MAILBOX_POLICIES={}
+    MAILBOX_DEFAULT_POLICY=BLOCK
+    MAILBOX_COALESCE={}
+
+    def __init__(self, time_base, on_quit=None):
+        """
+        @param time_base: in milliseconds
+        @param on_quit: callable used to exit the main loop
+        """
+        self.time_base=time_base
+        self.ticks_second=1000/time_base
+        self.on_quit=on_quit
+
+        self.mbox=Mailbox(self.MAILBOX_SIZE, self.MAILBOX_POLICIES,
+                          self.MAILBOX_DEFAULT_POLICY, self.MAILBOX_COALESCE)
+        mswitch.subscribe("__main__", self.mbox, self._interests)
+
+        self.interests=dict.fromkeys(self._interests or (), True)
+        self.responsesInterests=[]
+
+    def h_app_exit(self, *_):
+        self.on_destroy()
+
+    def on_destroy(self):
+        """
+        Exits the main loop
+        """
+        if self.on_quit is not None:
+            self.on_quit()
+
+    def tick(self, *_):
+        """
+        Performs message dispatch
+        """
+        #(src_agent, agent_name, agent_id,
+        #  interest_map, responsesInterestList,
+        #  mbox, processor, low_priority_burst_size=5, block=True)
+        ## never block the main loop
+        quit=process_queues(self, "__main__", "__main__",
+                       self.interests, self.responsesInterests,
+                       self.mbox, message_processor,
+                       self.LOW_PRIORITY_MESSAGE_BURST_SIZE, block=False
+                       )
+        if quit:
+            self.on_destroy()
+
+        ## for gobject... just in case
+        return True
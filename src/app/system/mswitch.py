@@ -10,19 +10,52 @@
     @revised: June 18, 2010
     @revised: August 22, 2010 : filtered-out "send to self" case 
     @revised: August 23, 2010 : added "snooping mode"   
+    @revised: per message type routing table
+    @revised: dual priority mailboxes - no more polling
+    @revised: static interest declaration on subscription
+    @revised: batched publication
+    @revised: backpressure on the publisher side
+    
+    Backpressure:
+    =============
+    The switch thread never waits on a subscriber's mailbox.  A publisher
+    is throttled instead, on its own thread, while a subscriber of the
+    message type has a full mailbox with the "block" policy: at most
+    BACKPRESSURE_TIMEOUT seconds per subscriber so that two Agents
+    publishing to each other can't deadlock.
+    
+    System messages are never throttled, nor are the messages of the
+    UNTHROTTLED_SOURCES: services shared by all Agents (e.g. the database
+    writer) must not wait on one of them.
 """
 
 from threading import Thread
-from Queue import Queue, Empty
 
-__all__=["publish", "subscribe", "observe_mode"]
+from app.system.mailbox import Mailbox
+
+__all__=["Batch", "publish", "publish_many", "subscribe", "observe_mode"]
 OBSERVE_FILTER_OUT=["__tick__", "log", "llog"]
 OBSERVE_FILTER_OUT_SOURCES=["__bridge__",]
+
+## seconds
+BACKPRESSURE_TIMEOUT=5
+
+## see app.system.dbservice
+UNTHROTTLED_SOURCES=["__db__",]
 #OSBSERVE_FILTER_OUT=["log", "llog"]
             
 observe_mode=False
 debugging_mode=False
 
+class Batch(tuple):
+    """
+    Payload of a batched message: a tuple of 'positional arguments' tuples
+    
+    A batch is routed once and delivered as a single mailbox item
+    to each subscriber.
+    """
+
+
 class CentralSwitch(Thread):
     """
     Simple message switch
@@ -30,9 +63,17 @@ class CentralSwitch(Thread):
     Really just broadcasts the received
     message to all 'clients' in 'split horizon'
     i.e. not sending back to originator
-    """
     
-    LOW_PRIORITY_BURST_SIZE=5
+    A routing table keyed on 'message type' is maintained
+    so that only the clients which are interested (or not
+    known yet to be uninterested) are visited on publication.
+    The table entries are built lazily and invalidated
+    upon subscription / interest changes.
+    
+    A client can declare its interests upfront when subscribing:
+    it then only receives the declared message types and the
+    dynamic "__interest__" protocol isn't needed for it.
+    """
     
     def __init__(self):
         Thread.__init__(self)
@@ -41,76 +82,45 @@ class CentralSwitch(Thread):
         
         self.imap={}
         self.clients=[]
-        self.iq=Queue()
         
-        ## system queue - high priority
-        self.isq=Queue()
+        ## mtype -> [(client_orig, client_mailbox, snooping), ...]
+        self.routes={}
+        
+        ## system messages go through the high priority lane
+        self.mbox=Mailbox()
     
     def run(self):
         """
         Main loop
         
-        Process the messages in the input queues of the switch.
+        Process the messages in the input mailbox of the switch.
         Each message is inspected and dispatched appropriately 
         to the client subscribers.
         
+        The thread sleeps until a message is available: the 
+        'high priority' system messages are always served first.
+        
         The system messages "__interest__" and "__quit__" are
         given special attention.
         """
         quit=False
         while not quit:
-            while True:
-                
-                ### There should be only a low volume/frequency
-                ### of 'high priority' system messages.
-                ### We'll get back through here soon enough i.e.
-                ###  after the other queue's timeout / 1 msg processed
-                try:
-                    envelope=self.isq.get(block=False)
-                    orig, mtype, payload=envelope
-                    
-                    if mtype=="__interest__":
-                        self.do_interest(payload)
-                    else:
-                        self.do_pub(orig, mtype, payload)
-                    ## We needed to give a chance to
-                    ## all threads to exit before
-                    ## committing "hara-kiri"
-                    if mtype=="__quit__":
-                        quit=True
-
-                    ## high priority messages are processed until
-                    ## exhaustion
-                    continue
-                except Empty:
-                    break
-    
-            burst=self.LOW_PRIORITY_BURST_SIZE
+            envelope=self.mbox.get()
+            orig, mtype, payload=envelope
             
-            while True:
-                try:            
-                    ## normal priority queue            
-                    envelope=self.iq.get(block=True, timeout=0.1)
-                    orig, mtype, payload=envelope
-                    if mtype=="__sub__":
-                        q, sq=payload
-                        self.do_sub(orig, q, sq)
-                    else:
-                        self.do_pub(orig, mtype, payload)
-
-                    if mtype=="__quit__":
-                        quit=True
-                                            
-                    #if mtype != "tick":
-                    #    print "mswitch: mtype(%s)" % mtype
-                    
-                    ## Only processed a "burst" of low priority messages
-                    ##  before checking the "high priority" queue
-                    burst -= 1
-                    if burst==0:
-                        break
-                except Empty:
-                    break
+            if mtype=="__interest__":
+                self.do_interest(payload)
+            elif mtype=="__sub__":
+                mbox, interests=payload
+                self.do_sub(orig, mbox, interests)
+            else:
+                self.do_pub(orig, mtype, payload)
+
+            ## We needed to give a chance to
+            ## all threads to exit before
+            ## committing "hara-kiri"
+            if mtype=="__quit__":
+                quit=True
         
         print "mswitch - shutdown"
         
@@ -119,53 +129,79 @@ class CentralSwitch(Thread):
         Add a 'subscriber' for 'mtype' to the "interested" list
         """
         payload, _kargs = args
-        agent_name, agent_id, mtype, interest, snooping, _q, _iq = payload
+        agent_name, agent_id, mtype, interest, snooping, _mbox = payload
         self.imap[(agent_id, mtype)]=(interest, snooping)
         
+        ## the route will be rebuilt on next publication
+        self.routes.pop(mtype, None)
+        
         if debugging_mode:
             print ":::: do_interest: source(%s) mtype(%s) interest(%s) snooping(%s)" % (agent_name, mtype, interest, snooping)
                
                 
-    def do_sub(self, orig, q, sq):
+    def do_sub(self, orig, mbox, interests):
         """
         Performs subscription
+        
+        @param interests: None or dict of {mtype: snooping}
         """
-        self.clients.append((orig, q, sq))
+        self.clients.append((orig, mbox, interests))
+        
+        ## a new client is interested in everything until told otherwise
+        self.routes.clear()
+        
+    def build_route(self, mtype):
+        """
+        Builds the list of subscribers for 'mtype'
+        
+        Agents which signaled no interest are left out entirely.
+        """
+        route=[]
+        for sorig, mbox, interests in self.clients:
+            
+            ## static declaration
+            if interests is not None:
+                if mtype in interests:
+                    route.append((sorig, mbox, interests[mtype]))
+                continue
+            
+            (interest,  snooping)=self.imap.get((sorig, mtype), (None, None))
+            
+            ### Agent notified interest OR not sure yet            
+            if interest==True or interest==None:
+                route.append((sorig, mbox, snooping))
+                
+        self.routes[mtype]=route
+        return route
         
     def do_pub(self, orig, mtype, payload):
         """
         Performs message distribution
         """
         #print "do_pub: mtype: %s  payload: %s" % (mtype, payload)
-        for sorig, q, sq in self.clients:
+        route=self.routes.get(mtype, None)
+        if route is None:
+            route=self.build_route(mtype)
+        
+        system=mtype.startswith("__")
+        for sorig, mbox, snooping in route:
             
             ## don't send to self!
             if sorig==orig:
                 continue
             
-            (interest,  snooping)=self.imap.get((sorig, mtype), (None, None))
-            
             if observe_mode:
                 if mtype not in OBSERVE_FILTER_OUT:
                     if orig not in OBSERVE_FILTER_OUT_SOURCES:
-                        if interest:
-                            print "<<< do_pub: orig(%s) interest(%s) mtype(%s) q(%s) sq(%s)" % (orig, interest, mtype, q, sq)
+                        print "<<< do_pub: orig(%s) mtype(%s) mbox(%s)" % (orig, mtype, mbox)
                 
-            ### Agent notified interest OR not sure yet            
-            if interest==True or interest==None:
-
-                if mtype.startswith("__"):
-                    if snooping:
-                        sq.put((orig, mtype, None), block=False)
-                    else:
-                        sq.put((orig, mtype, payload), block=False)
-                else:
-                    if snooping:
-                        q.put((orig, mtype, None), block=False)
-                    else:
-                        q.put((orig, mtype, payload), block=False)
+            ## batches are unpacked on the receiving end, snooping or not
+            if snooping and type(payload) is not Batch:
+                mbox.put((orig, mtype, None), system)
+            else:
+                mbox.put((orig, mtype, payload), system)
             #if mtype!="tick":                    
-            #    print ">>> do_pub: mtype(%s) q(%s) sq(%s)" % (mtype, q, sq)
+            #    print ">>> do_pub: mtype(%s) mbox(%s)" % (mtype, mbox)
     
 
 
@@ -174,24 +210,57 @@ class CentralSwitch(Thread):
 ## =============================================================== 
         
 
+def _throttle(orig, msgType):
+    """
+    Waits for room in the mailboxes of the subscribers of 'msgType'
+    
+    The route is only read: it is built by the switch thread on first publication.
+    """
+    if orig in UNTHROTTLED_SOURCES:
+        return
+    route=_switch.routes.get(msgType, None)
+    if route is None:
+        return
+    for sorig, mbox, _snooping in route:
+        if sorig!=orig:
+            mbox.waitRoom(msgType, BACKPRESSURE_TIMEOUT)
+
+
 def publish(orig, msgType, *pargs, **kargs):
     """
     Publish a 'message' of type 'msgType' to
     all registered 'clients'
+    
+    Waits while a subscriber can't keep up - see 'Backpressure'
+    """
+    if not msgType.startswith("__"):
+        _throttle(orig, msgType)
+    _switch.mbox.put((orig, msgType, (pargs, kargs)), msgType.startswith("__"))
+    
+    
+def publish_many(orig, msgType, iargs):
+    """
+    Publish a batch of 'messages' of type 'msgType'
+    
+    @param iargs: iterable of 'positional arguments' tuples, one per message 
     """
-    if msgType.startswith("__"):
-        _switch.isq.put((orig, msgType, (pargs, kargs)), block=False)
-    else:
-        _switch.iq.put((orig, msgType, (pargs, kargs)), block=False)
+    batch=Batch(iargs)
+    if batch:
+        if not msgType.startswith("__"):
+            _throttle(orig, msgType)
+        _switch.mbox.put((orig, msgType, batch), msgType.startswith("__"))
     
     
-def subscribe(orig, q, sq, _msgType=None):
+def subscribe(orig, mbox, interests=None):
     """
-    Subscribe a 'client' to all the switch messages
+    Subscribe a 'client' to the switch messages
      
-    @param q: client's input queue
+    @param mbox: client's input mailbox
+    @param interests: dict of {mtype: snooping} for a static declaration
+                      or None to receive all messages until "__interest__"
+                      is signaled for each message type
     """
-    _switch.iq.put((orig, "__sub__", (q, sq)))
+    _switch.mbox.put((orig, "__sub__", (mbox, interests)))
     
 
 
@@ -0,0 +1,147 @@
+"""
+    Agent registry
+
+    * Agents are declared with a factory and their dependencies
+    * Construction happens concurrently, level by level,
+      following the declared dependencies: an Agent is started
+      only once all the Agents it depends on are started
+    * Debug Agents are excluded unless requested
+    * Agents requiring a desktop session ('gui') can be excluded (headless mode)
+    * A timing report of the startup is produced
+
+    Usage:
+        registry.register("ratings_db", factory, requires=[], debug=False, gui=False)
+        agents, report=registry.start_all()
+        print registry.format_report(report)
+
+    Created on 2010-09-05
+    @author: jldupont
+"""
+from threading import Thread
+import sys
+import time
+
+__all__=["register", "start_all", "format_report"]
+
+_specs=[]
+
+
+class AgentSpec(object):
+    def __init__(self, name, factory, requires, debug, gui):
+        self.name=name
+        self.factory=factory
+        self.requires=list(requires)
+        self.debug=debug
+        self.gui=gui
+
+
+class _Builder(Thread):
+    """
+    Constructs & starts one Agent
+    """
+    def __init__(self, spec):
+        Thread.__init__(self)
+        self.spec=spec
+        self.agent=None
+        self.duration=0.0
+        self.exc_info=None
+
+    def run(self):
+        start=time.time()
+        try:
+            self.agent=self.spec.factory()
+            start_method=getattr(self.agent, "start", None)
+            if start_method is not None:
+                start_method()
+        except:
+            self.exc_info=sys.exc_info()
+        self.duration=time.time()-start
+
+
+def register(name, factory, requires=(), debug=False, gui=False):
+    """
+    Declares an Agent
+
+    @param factory: callable returning the Agent instance
+    @param requires: names of the Agents to start beforehand
+    @param debug: True for development only Agents
+    @param gui: True for Agents requiring a desktop session
+    """
+    _specs.append(AgentSpec(name, factory, requires, debug, gui))
+
+
+def _levels(specs, excluded=()):
+    """
+    Orders the Agents in dependency levels
+
+    The dependencies on 'excluded' Agents are ignored.
+
+    @raise RuntimeError: unknown dependency or dependency cycle
+    """
+    names=set([spec.name for spec in specs])
+    requires={}
+    for spec in specs:
+        requires[spec.name]=set([dep for dep in spec.requires if dep not in excluded])
+        for dep in requires[spec.name]:
+            if dep not in names:
+                raise RuntimeError("Agent '%s' requires unknown Agent '%s'" % (spec.name, dep))
+
+    done=set()
+    remaining=list(specs)
+    levels=[]
+    while remaining:
+        level=[spec for spec in remaining if requires[spec.name] <= done]
+        if not level:
+            raise RuntimeError("Agents dependency cycle: %s" % [spec.name for spec in remaining])
+        levels.append(level)
+        done.update([spec.name for spec in level])
+        remaining=[spec for spec in remaining if spec.name not in done]
+    return levels
+
+
+def start_all(include_debug=False, include_gui=True):
+    """
+    Constructs & starts the registered Agents
+
+    @return (agents, report)
+
+    agents: {name: agent}
+    report: [(name, level, duration_seconds), ...]
+
+    @raise: the first exception raised by an Agent factory
+    """
+    specs=[spec for spec in _specs
+           if (include_debug or not spec.debug) and (include_gui or not spec.gui)]
+    excluded=set([spec.name for spec in _specs])-set([spec.name for spec in specs])
+
+    agents={}
+    report=[]
+    for index, level in enumerate(_levels(specs, excluded)):
+        builders=[_Builder(spec) for spec in level]
+        for builder in builders:
+            builder.start()
+        for builder in builders:
+            builder.join()
+
+        for builder in builders:
+            if builder.exc_info is not None:
+                exc_type, exc_value, tb=builder.exc_info
+                raise exc_type, exc_value, tb
+            agents[builder.spec.name]=builder.agent
+            report.append((builder.spec.name, index, builder.duration))
+
+    return (agents, report)
+
+
+def format_report(report, since=None):
+    """
+    Formats the startup timing report
+
+    @param since: reference time (e.g. process start) for the total
+    """
+    lines=["Startup report:"]
+    for name, level, duration in report:
+        lines.append("  [%s] %-16s %7.1f ms" % (level, name, duration*1000))
+    if since is not None:
+        lines.append("  agents ready after %.1f ms" % ((time.time()-since)*1000))
+    return "\n".join(lines)
@@ -0,0 +1,180 @@
+"""
+    Timers service - hierarchical timer wheel
+
+    Replaces the broadcast of "__tick__" to all Agents: an Agent
+    registers its timers once and only receives the callbacks
+    which are due, as direct "__timer__" messages in its mailbox.
+
+    Timer Entry:
+    ============
+        (base, interval, callback_name)
+
+        base: "sec", "min", "hour" or "day"
+
+    Message:
+    ========
+        "__timer__" (base, count, callback_name)
+
+        count: number of 'base' units elapsed since the service started
+
+    The wheel is advanced once per second by the service thread:
+    a timer is kept in the wheel matching its remaining delay
+    (seconds, minutes, hours) and cascaded down as time goes by.
+
+    Created on 2010-09-03
+    @author: jldupont
+"""
+from threading import Thread, Lock
+import time
+
+__all__=["TimerWheel", "register", "UNITS", "TIMER_SOURCE"]
+
+TIMER_SOURCE="__timers__"
+
+UNITS={"sec":  1
+       ,"min":  60
+       ,"hour": 3600
+       ,"day":  86400
+       }
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel with a resolution of 1 second
+
+    Entries: [due, period, target]
+    """
+    def __init__(self):
+        self.now=0
+        self.secs=[[] for _ in xrange(60)]
+        self.mins=[[] for _ in xrange(60)]
+        self.hours=[[] for _ in xrange(24)]
+        self.days=[]
+
+    def add(self, period, target, due=None):
+        """
+        Adds a periodic timer
+
+        @param period: in seconds
+        @param due: absolute time of the first expiry, defaults to now+period
+        """
+        if due is None:
+            due=self.now+period
+        self._insert([due, period, target])
+
+    def _insert(self, entry):
+        due=entry[0]
+        delta=due-self.now
+        if delta<60:
+            self.secs[due % 60].append(entry)
+        elif delta<3600:
+            self.mins[(due // 60) % 60].append(entry)
+        elif delta<86400:
+            self.hours[(due // 3600) % 24].append(entry)
+        else:
+            self.days.append(entry)
+
+    def _cascade(self, entries):
+        for entry in entries:
+            self._insert(entry)
+
+    def advance(self):
+        """
+        Advances the wheel by 1 second
+
+        @return list of the targets due
+        """
+        self.now += 1
+        now=self.now
+
+        ## cascade from the top down
+        if now % 86400 == 0:
+            days, self.days = self.days, []
+            self._cascade(days)
+        if now % 3600 == 0:
+            index=(now // 3600) % 24
+            hours, self.hours[index] = self.hours[index], []
+            self._cascade(hours)
+        if now % 60 == 0:
+            index=(now // 60) % 60
+            mins, self.mins[index] = self.mins[index], []
+            self._cascade(mins)
+
+        index=now % 60
+        slot, self.secs[index] = self.secs[index], []
+        due=[]
+        for entry in slot:
+            if entry[0]==now:
+                due.append(entry[2])
+                entry[0] += entry[1]
+            self._insert(entry)
+        return due
+
+
+class TimerService(Thread):
+    """
+    Drives the timer wheel and delivers the "__timer__" messages
+    """
+    def __init__(self):
+        Thread.__init__(self)
+        self.setDaemon(True)
+        self.lock=Lock()
+        self.wheel=TimerWheel()
+
+    def register(self, mbox, timers_spec):
+        """
+        Registers the timers of an Agent
+
+        The timers are aligned on their period since the service started
+        """
+        self.lock.acquire()
+        try:
+            for base, interval, callback_name in timers_spec:
+                unit=UNITS[base]
+                period=interval*unit
+                due=(self.wheel.now // period + 1) * period
+                self.wheel.add(period, (mbox, base, unit, callback_name), due)
+        finally:
+            self.lock.release()
+
+    def run(self):
+        deadline=time.time()
+        while True:
+            deadline += 1
+            delay=deadline-time.time()
+            if delay>0:
+                time.sleep(delay)
+
+            self.lock.acquire()
+            try:
+                due=self.wheel.advance()
+                now=self.wheel.now
+            finally:
+                self.lock.release()
+
+            for mbox, base, unit, callback_name in due:
+                mbox.put((TIMER_SOURCE, "__timer__", ((base, now // unit, callback_name), {})), True)
+
+
+## ===============================================================
+## =============================================================== API functions
+## ===============================================================
+
+_service=TimerService()
+_start_lock=Lock()
+
+
+def register(mbox, timers_spec):
+    """
+    Registers timers to be delivered to 'mbox'
+
+    @param timers_spec: list of (base, interval, callback_name)
+    """
+    _start_lock.acquire()
+    try:
+        if not _service.isAlive():
+            _service.start()
+    finally:
+        _start_lock.release()
+
+    _service.register(mbox, timers_spec)
@@ -1,10 +1,19 @@
 """
     MuSync
     
+    Usage:
+        python musync.py [--headless]
+        
+        --headless : runs the agents on a plain GLib main loop,
+                     without gtk i.e. no tray icon / ui window
+    
     @author: jldupont
 """
 import os
 import sys
+import time
+
+START_TIME=time.time()
 
 APP_NAME = "musync"
 APP_ICON = APP_NAME
@@ -28,8 +37,11 @@ MSWITCH_OBSERVE_MODE=False
 MSWITCH_DEBUGGING_MODE=False
 MSWITCH_DEBUG_INTEREST=False
 DEV_MODE=True
+DEBUG_AGENTS=False   ## e.g. TesterAgent
 ###>>>
 
+HEADLESS="--headless" in sys.argv[1:]
+
 ## For development environment
 ppkg=os.path.abspath( os.getcwd() +"/app")
 if os.path.exists(ppkg):
@@ -46,7 +58,6 @@ except:
 import gobject
 import dbus.glib
 from dbus.mainloop.glib import DBusGMainLoop
-import gtk
 
 try:
     gobject.threads_init()  #@UndefinedVariable
@@ -61,58 +72,87 @@ try:
     mswitch.debugging_mode=MSWITCH_DEBUGGING_MODE
     
     ### ===========================================================
-    ### Agents which require configuration
-    ###
-    from app.agents.notifier import NotifierAgent
-    import app.agents.ratings_dbus  #@UnresolvedImport @UnusedImport
-    from app.agents.ratings_cache import RatingsCacheAgent
-    _rca=RatingsCacheAgent(DB_PATH, DEV_MODE)
-    _rca.start()
-    
-    from app.agents.ratings_db import RatingsDbAgent
-    _rda=RatingsDbAgent(DB_PATH, DEV_MODE)
-    _rda.start()
-    
-    import app.agents.mb_dbus       #@UnresolvedImport @UnusedImport
-    
-    from app.agents.tray import TrayAgent
-    _ta=TrayAgent(APP_NAME, ICON_PATH, ICON_FILE, HELP_URL)
-    
-    _na=NotifierAgent(APP_NAME, APP_ICON)
-    _na.start()
-    
-    from app.agents.logger import LoggerAgent
-    _la=LoggerAgent(APP_NAME, LOG_PATH)
-    _la.start()
-    
-    #from app.agents.ratings_cache import UploadCacheAgent
-    #_uca=UploadCacheAgent(DB_PATH, DEV_MODE)
-    #_uca.start()
-    
-    #from app.agents.cache import CacheAgent
-    #_ca=CacheAgent(DB_PATH, DEV_MODE)
-    #_ca.start()
-    
-    from app.agents._tester import TesterAgent  #@UnusedImport
-    import app.agents.monitor #@UnresolvedImport @UnusedImport
-    
-    from app.agents.uploader import UploaderAgent
-    _upa=UploaderAgent(WS_RATINGS_END_POINT, SERVER, PORT, CONSUMER_KEY, CONSUMER_SECRET, DEV_MODE)
-    _upa.start()
-    
-    ### ===========================================================
+    ### Agents: constructed & started concurrently following
+    ###  their declared dependencies
     ###
-    
-    #from app.agents import adbus
-    from app.agents.authorize import AuthorizeAgent  #@UnusedImport
-    _authAgent=AuthorizeAgent(APP_NAME, SERVER, PORT, CONSUMER_KEY, CONSUMER_SECRET, OAUTH_BASE)
-    _authAgent.start()
-    
-    from app.agents.ui import UiAgent
-    _uia=UiAgent(TIME_BASE)
-    gobject.timeout_add(TIME_BASE, _uia.tick)
-    
-    gtk.main()
+    from app.system import registry
+    
+    def _ratings_db():
+        from app.agents.ratings_db import RatingsDbAgent
+        return RatingsDbAgent(DB_PATH, DEV_MODE)
+    
+    def _ratings_cache():
+        from app.agents.ratings_cache import RatingsCacheAgent
+        return RatingsCacheAgent(DB_PATH, DEV_MODE)
+    
+    def _ratings_dbus():
+        from app.agents.ratings_dbus import DbusAgent
+        return DbusAgent()
+    
+    def _mb_dbus():
+        from app.agents.mb_dbus import DbusAgent
+        return DbusAgent()
+    
+    def _monitor():
+        from app.agents.monitor import MonitoringAgent
+        return MonitoringAgent()
+    
+    def _notifier():
+        from app.agents.notifier import NotifierAgent
+        return NotifierAgent(APP_NAME, APP_ICON)
+    
+    def _logger():
+        from app.agents.logger import LoggerAgent
+        return LoggerAgent(APP_NAME, LOG_PATH)
+    
+    def _uploader():
+        from app.agents.uploader import UploaderAgent
+        return UploaderAgent(WS_RATINGS_END_POINT, SERVER, PORT, CONSUMER_KEY, CONSUMER_SECRET, DEV_MODE)
+    
+    def _authorize():
+        from app.agents.authorize import AuthorizeAgent
+        return AuthorizeAgent(APP_NAME, SERVER, PORT, CONSUMER_KEY, CONSUMER_SECRET, OAUTH_BASE)
+    
+    def _tester():
+        from app.agents._tester import TesterAgent
+        return TesterAgent()
+    
+    ## the Dbus facing agents are started last: nothing gets lost
+    registry.register("logger",        _logger)
+    registry.register("notifier",      _notifier, gui=True)
+    registry.register("ratings_db",    _ratings_db)
+    registry.register("ratings_cache", _ratings_cache, requires=["ratings_db"])
+    registry.register("monitor",       _monitor)
+    registry.register("authorize",     _authorize)
+    registry.register("uploader",      _uploader)
+    registry.register("mb_dbus",       _mb_dbus,      requires=["ratings_cache", "monitor"])
+    registry.register("ratings_dbus",  _ratings_dbus, requires=["ratings_db"])
+    registry.register("tester",        _tester, debug=True)
+    
+    _agents, _report=registry.start_all(include_debug=DEBUG_AGENTS, include_gui=not HEADLESS)
+    
+    _startup_report=registry.format_report(_report, START_TIME)
+    print _startup_report
+    mswitch.publish("__main__", "log", _startup_report)
+    
+    if not HEADLESS:
+        from app.agents.tray import TrayAgent
+        _ta=TrayAgent(APP_NAME, ICON_PATH, ICON_FILE, HELP_URL)
+    
+    if HEADLESS:
+        from app.system.main_base import MainAgentBase
+        _loop=gobject.MainLoop()
+        _ma=MainAgentBase(TIME_BASE, _loop.quit)
+        gobject.timeout_add(TIME_BASE, _ma.tick)
+        
+        _loop.run()
+    else:
+        import gtk
+        from app.agents.ui import UiAgent
+        _uia=UiAgent(TIME_BASE)
+        gobject.timeout_add(TIME_BASE, _uia.tick)
+    
+        gtk.main()
     
 except Exception,e:
     from app.agents.notifier import notify #@Reimport